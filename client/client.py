@@ -1,152 +1,116 @@
 
-from distutils.log import Log
-import select
-import socket
+import asyncio
 import sys
 import time
-from base64 import b64decode
-from socket import socket as Socket
-from threading import Thread
-from typing import Dict
+from concurrent.futures import Future
+from concurrent.futures import wait as wait_futures
+from os import path
+from typing import Dict, List, Optional
 
-from core.exceptions import FileTooLargeError, ForumBaseException
+from core.client_core import ClientCore
 from core.payload_helper import PayloadHelper
-from core.utils import json_deserializer, random_str, package_file
+from core.tcp_pool import TCPPool
+from core.utils import COMPRESS_ZLIB, MAX_DATAGRAM, random_str
+from core.wire import PROTO_BINARY
 
 CMDS = ('CRT', 'LST', 'MSG', 'EDT', 'DLT',
-        'RDT', 'UPD', 'DWN', 'RMV', 'XIT', 'HLP')
+        'RDT', 'UPD', 'DWN', 'RMV', 'XIT', 'HLP', 'BAT')
 
-SUDP = Socket(socket.AF_INET, socket.SOCK_DGRAM)
+FILE_TIMEOUT = 600
 
+# Seconds between heartbeats, skipped after a recent request
+HEARTBEAT_INTERVAL = 10
 
-RECV_BYTES = 8192
-RETRIES = 3
+# Items per LST / RDT page, keeps each response within one datagram
+PAGE_SIZE = 20
 
-Token = ''
-ServerAddr = ''
+# Commands of a BAT script sent in one request, the server takes up to 64;
+# fewer when they do not fit in MAX_DATAGRAM
+BATCH_SIZE = 64
 
-EchoDict: Dict[str, bytes] = {}
+# Offered in the meta handshake, None keeps JSON / uncompressed responses
+PROTO = PROTO_BINARY
+COMPRESS = COMPRESS_ZLIB
 
+Token = ''
+ServerAddr = ''
 
-def thread_heartbeat():
-    '''Thread sending heartbeat to server'''
+# Binary payloads negotiated, they carry integer echoes
+Binary = False
+EchoNo = 0
 
-    while True:
-        if Token:
-            echo = random_str()
-            payload = PayloadHelper.request_command('HEART', Token, None, echo)
-            SUDP.sendto(payload, ServerAddr)
+# Compressed responses negotiated
+Compress = False
 
-        time.sleep(10)
+# When the last request was sent
+LastSent = 0.0
 
+# Event loop thread running every request, started on first use
+Core: Optional[ClientCore] = None
+# Kept alive TCP connections for UPD / DWN, opened on first use
+TCP_POOL: Optional[TCPPool] = None
 
-def thread_network_send_udp(echo, payload):
-    '''Thread sending data via UDP'''
-    for _ in range(RETRIES + 1):
-        SUDP.sendto(payload, ServerAddr)
-        time.sleep(5)
 
-        if EchoDict.get(echo, None) or echo not in EchoDict:
-            break
+def new_echo():
+    '''Echo of a UDP request'''
+    global EchoNo
+    if not Binary:
+        return random_str()
 
+    EchoNo = EchoNo % 0xFFFFFFFF + 1
+    return EchoNo
 
-def thread_network_send_tcp(echo, payload):
-    '''Thread sending data via TCP'''
-    STCP = Socket(socket.AF_INET, socket.SOCK_STREAM)
-    STCP.setblocking(True)
 
-    for _ in range(RETRIES + 1):
-        try:
-            STCP.connect(ServerAddr)
-            STCP.send(payload)
-            raw = STCP.recv(RECV_BYTES)
-            response_handler(raw)
-            STCP.close()
-            time.sleep(2)
-
-            if EchoDict.get(echo, None) or echo not in EchoDict:
-                break
-        except OSError as e:
-            log(f'TCP send error: {e}', True)
+def network_core() -> ClientCore:
+    '''Start the network core and the TCP pool once ServerAddr is known'''
+    global Core, TCP_POOL
+    if Core is None:
+        Core = ClientCore(ServerAddr, response_handler,
+                          lambda msg: log(msg, True))
+        TCP_POOL = TCPPool(ServerAddr, Core.feed,
+                           lambda msg: log(msg, True))
+    return Core
 
 
-def thread_network_recv():
-    '''Thread receiving data'''
-    inputs = [SUDP]
+async def heartbeat():
+    '''Send heartbeats to server on the network core, every request renews the session too'''
 
     while True:
-        rlist, _, _ = select.select(inputs, [], [], 1)
-        for event in rlist:
-            try:
-                if event == SUDP:
-                    # UDP message
-                    data, _ = event.recvfrom(RECV_BYTES)
-                    response_handler(data)
-            except ConnectionResetError as e:
-                log(e, True)
-
-
-def response_handler(raw: bytes):
-    '''Handle UDP message'''
-    global Token
-    try:
-        payload = json_deserializer(raw)
-        echo = payload['echo']
-
-        if 'code' in payload and 'msg' in payload:
-            reply = True
-            if 'error' in payload:  # error message
-                if payload['error'] == 'AuthenticationError':
-                    Token = ''
-
-        elif 'meta' in payload:  # meta
-            reply = payload.get('reply', False)
-
-        else:
-            log(f'Unrecognized payload: {payload}', True)
-            return
-
-        if echo in EchoDict:
-            EchoDict[echo] = payload
-
-        if reply:
-            payload = PayloadHelper.request_meta(echo, False)
-            SUDP.sendto(payload, ServerAddr)
+        if Token and time.time() - LastSent >= HEARTBEAT_INTERVAL:
+            if Binary:
+                payload = PayloadHelper.request_heartbeat(Token)
+            else:
+                payload = PayloadHelper.request_command(
+                    'HEART', Token, None, new_echo())
+            Core.send(payload)
 
-    except KeyError as e:
-        log(f'Bad payload: {payload}', True)
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
 
-    except ForumBaseException as e:
-        log(e.msg, True)
 
-    except Exception as e:
-        log(f'Unknown error: {e}', True)
+def response_handler(payload: Dict):
+    '''Called by the network core for every response'''
+    global Token
+    if payload.get('error', None) == 'AuthenticationError':
+        Token = ''
 
 
-def waiting_screen(key: str, timeout: int = 10):
-    '''Waiting for response'''
+def waiting_screen(future: Future):
+    '''Show a spinner until the response arrives, return it'''
     ascii = ['|', '/', '-', '\\']
 
     i = 0
-    end = time.time() + timeout
-
-    while time.time() < end:
-        if EchoDict.get(key, None):
-            print('\r', end='')
-            return
-
-        char = ascii[i]
-        if i < 3:
-            i += 1
-        else:
-            i = 0
+    while not wait_futures([future], 0.1).done:
+        print(f'\rWating {ascii[i]}', end='')
+        i = (i + 1) % len(ascii)
 
-        print(f'\rWating {char}', end='')
-
-        time.sleep(0.1)
+    try:
+        result = future.result()
+    except TimeoutError:
+        print('\r \033[31mProcess Timeout!\033[0m\n')
+        raise
 
-    print('\r \033[31mProcess Timeout!\033[0m\n')
-    raise TimeoutError('Timeout!')
+    print('\r', end='')
+    return result
 
 
 def log(msg: str,  error: bool = False):
@@ -175,25 +139,74 @@ def ipt(user: str):
             return txt
 
 
-def call_with_retries(payload: bytes, echo: str, upd: bool = True, timeout: int = 10):
-    '''Call server with retries'''
-    EchoDict[echo] = None
-    target = thread_network_send_udp if upd else thread_network_send_tcp
-    Thread(target=target, args=(echo, payload), daemon=True).start()
-    waiting_screen(echo, timeout)
-    result = EchoDict.pop(echo)
-    return result
+def call_with_retries(payload: bytes, echo: str, upd: bool = True, timeout: int = 10, src: str = None, dst: str = None):
+    '''Call server, UDP requests are sent again until the response arrives or timeout'''
+    global LastSent
+    core = network_core()
+    LastSent = time.time()
+    if upd:
+        coro = core.request(payload, echo, timeout)
+    else:
+        coro = core.wait(echo, timeout, lambda: TCP_POOL.request(
+            echo, payload, src, dst))
+    return waiting_screen(core.submit(coro))
+
+
+def call_batch(lines: List[str], timeout: int = 10) -> List[Dict]:
+    '''Send commands in batches that fit in a datagram, return their responses in order
+
+    Stops once a batch fails as a whole or the session ends with XIT.
+    '''
+    commands = []
+    for line in lines:
+        args = line.split(' ')
+        commands.append(PayloadHelper.request_command(
+            args[0], None, ' '.join(args[1:]), new_echo(),
+            compress=Compress, binary=Binary))
+
+    responses = []
+    while commands:
+        # a command too large for a datagram still goes alone
+        echo = new_echo()
+        count = 1
+        payload = PayloadHelper.request_batch(
+            Token, commands[:1], echo, binary=Binary)
+        while count < min(len(commands), BATCH_SIZE):
+            larger = PayloadHelper.request_batch(
+                Token, commands[:count + 1], echo, binary=Binary)
+            if len(larger) > MAX_DATAGRAM:
+                break
+            payload = larger
+            count += 1
+        commands = commands[count:]
+
+        data = call_with_retries(payload, echo, True, timeout)
+        batch = data.get('batch', None)
+        if batch is None:
+            responses.append(data)
+            break
+
+        responses.extend(batch)
+        if any(response['code'] == 201 for response in batch):
+            break
+
+    return responses
 
 
 def test_server_connection():
-    '''Test server connection'''
+    '''Test server connection, negotiate the payload format'''
+    global Binary, Compress
     while True:
         try:
             log(f'Connecting to {ServerAddr[0]}:{ServerAddr[1]} ...', False)
 
             echo = random_str()
-            payload = PayloadHelper.request_meta(echo, True)
-            call_with_retries(payload, echo, True, 10)
+            payload = PayloadHelper.request_meta(echo, True, PROTO, COMPRESS)
+            data = call_with_retries(payload, echo, True, 10)
+
+            # an older server does not answer proto and keeps JSON
+            Binary = PROTO == PROTO_BINARY and data.get('proto') == PROTO_BINARY
+            Compress = bool(COMPRESS) and data.get('compress') == COMPRESS
 
             log('Connected!', False)
             break
@@ -213,8 +226,9 @@ def interactive_login() -> str:
     while True:
         username = ipt('Enter username:')
 
-        echo = random_str()
-        payload = PayloadHelper.request_auth(username, '', True, echo)
+        echo = new_echo()
+        payload = PayloadHelper.request_auth(
+            username, '', True, echo, binary=Binary)
         data = call_with_retries(payload, echo, True, 10)
 
         code = data['code']
@@ -236,8 +250,9 @@ def interactive_login() -> str:
 
         passwd = ipt('Enter password:')
 
-        echo = random_str()
-        payload = PayloadHelper.request_auth(username, passwd, True, echo)
+        echo = new_echo()
+        payload = PayloadHelper.request_auth(
+            username, passwd, True, echo, binary=Binary)
         data = call_with_retries(payload, echo, True, 10)
 
         code = data['code']
@@ -260,8 +275,9 @@ def interactive_register() -> str:
     while True:
         username = ipt('Enter username:')
 
-        echo = random_str()
-        payload = PayloadHelper.request_auth(username, '', False, echo)
+        echo = new_echo()
+        payload = PayloadHelper.request_auth(
+            username, '', False, echo, binary=Binary)
         data = call_with_retries(payload, echo, True, 10)
 
         code = data['code']
@@ -273,8 +289,9 @@ def interactive_register() -> str:
 
         passwd = ipt('Enter password:')
 
-        echo = random_str()
-        payload = PayloadHelper.request_auth(username, passwd, False, echo)
+        echo = new_echo()
+        payload = PayloadHelper.request_auth(
+            username, passwd, False, echo, binary=Binary)
         data = call_with_retries(payload, echo, True, 10)
 
         code = data['code']
@@ -304,56 +321,78 @@ def interactive_commdline(user: str) -> str:
         cmd = args[0]
         argv = ' '.join(args[1:])
 
-        echo = random_str()
+        # file transfers use TCP, which always carries JSON
+        echo = random_str() if cmd in ('UPD', 'DWN') else new_echo()
+
+        if cmd == 'BAT':
+            # run the commands of a script file in batches
+            try:
+                with open(argv, encoding='utf-8') as f:
+                    lines = [line.strip() for line in f if line.strip()]
+            except OSError:
+                logcmd(f'File {argv} not found!', True)
+                continue
+
+            for data in call_batch(lines):
+                code = data['code']
+                msg = data.get('data', None) or data.get(
+                    'msg', None) or 'Unknown Error'
+                if code == 201:
+                    log(msg, True)
+                    return
+                logcmd(msg, code != 200)
+            continue
 
-        if cmd == 'UPD':
+        elif cmd == 'UPD':
             title = ' '.join(args[1:-1])
             name = args[-1]
+            f_name = path.basename(name)
             try:
-                f_name, f_body = package_file(name)
-            except FileTooLargeError:
-                logcmd(f'File {f_name} too large!', True)
-                continue
-            except IOError:
+                f_size = path.getsize(name)
+            except OSError:
                 logcmd(f'File {name} not found!', True)
                 continue
-            except Exception as e:
-                logcmd(f'Unknown error: {e}', True)
-                continue
 
             payload = PayloadHelper.request_file(
-                f_name, f_body, title, Token, True, echo)
-            data = call_with_retries(payload, echo, False, 10)
+                f_name, f_size, title, Token, True, echo)
+            data = call_with_retries(
+                payload, echo, False, FILE_TIMEOUT, src=name)
 
         elif cmd == 'DWN':
             title = ' '.join(args[1:-1])
             f_name = args[-1]
 
             payload = PayloadHelper.request_file(
-                f_name, "", title, Token, False, echo)
-            data = call_with_retries(payload, echo, False, 10)
+                f_name, 0, title, Token, False, echo)
+            data = call_with_retries(
+                payload, echo, False, FILE_TIMEOUT, dst='.')
+
+        elif cmd in ('LST', 'RDT'):
+            # show every page but the last one, which is handled below
+            cursor = 0
+            while True:
+                payload = PayloadHelper.request_command(
+                    cmd, Token, argv, echo, cursor, PAGE_SIZE,
+                    compress=Compress, binary=Binary)
+                data = call_with_retries(payload, echo, True, 10)
+
+                cursor = data.get('cursor', None)
+                if data['code'] != 200 or cursor is None:
+                    break
+
+                logcmd(data['data'], False)
+                echo = new_echo()
 
         else:
-            payload = PayloadHelper.request_command(cmd, Token, argv, echo)
+            payload = PayloadHelper.request_command(
+                cmd, Token, argv, echo, compress=Compress, binary=Binary)
             data = call_with_retries(payload, echo, True, 10)
 
         code = data['code']
         msg = data.get('data', None) or data.get(
             'msg', None) or 'Unknown Error'
         if code == 200:
-            if cmd=='DWN':
-                try:
-                    body = data['body']
-                    raw = b64decode(body.encode('utf-8'))
-                    with open(f_name, 'wb') as f:
-                        f.write(raw)
-                    logcmd(msg, False)    
-                except IOError:
-                    logcmd(f'Download file {f_name} error!', True)
-                except Exception as e:
-                    logcmd(f'Unknown error: {e}', True)
-            else:
-                logcmd(msg, False)
+            logcmd(msg, False)
         elif code == 201:
             log(msg, True)
             return
@@ -405,11 +444,10 @@ if __name__ == '__main__':
             input()
             exit(1)
 
-        Thread(target=thread_heartbeat, daemon=True).start()
-        Thread(target=thread_network_recv, daemon=True).start()
-
         ServerAddr = (host, port)
 
+        network_core().submit(heartbeat())
+
         while True:
             try:
                 main()
@@ -0,0 +1,232 @@
+import asyncio
+import socket
+import threading
+from base64 import b64decode
+from concurrent.futures import Future as ThreadFuture
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from .exceptions import ForumBaseException
+from .payload_helper import PayloadHelper
+from .wire import deserialize, is_binary
+
+# Retransmission timeout as in RFC 6298: before the first RTT sample and
+# its bounds, a request is sent again after RTO, 2 RTO, 4 RTO ...
+RTO_INITIAL = 1.0
+RTO_MIN = 0.2
+RTO_MAX = 8.0
+# Gains of the smoothed RTT and of its variation
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+
+# Fragment numbers in one retransmit request
+RESEND_MAX = 256
+
+
+class RTTEstimator:
+    '''Smoothed round trip time and the retransmission timeout derived from it'''
+    srtt: Optional[float] = None
+    rttvar = 0.0
+    rto = RTO_INITIAL
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, RTO_MIN), RTO_MAX)
+
+
+class ClientCore(asyncio.DatagramProtocol):
+    '''Network core of the client, an event loop on its own thread
+
+    Every request waits on a future of its echo, which completes as soon as
+    the response arrives. A UDP request is sent again once the RTO passes,
+    doubling it each time; only the missing fragments are asked for if the
+    response is partly received. Responses received on TCP are passed to
+    feed(). on_payload is called on the loop thread for every response.
+    '''
+    addr: Tuple[str, int]
+    on_payload: Callable[[Dict], None]
+    on_error: Callable[[str], None]
+    loop: asyncio.AbstractEventLoop
+    transport: asyncio.DatagramTransport = None
+    rtt: RTTEstimator
+
+    waiters: Dict[Any, asyncio.Future]
+    # when requests not sent again yet were sent, Karn's algorithm only
+    # samples the RTT of those
+    sent_at: Dict[Any, float]
+    # fragments of responses being reassembled and when the last one arrived
+    frags: Dict[Any, List[Optional[bytes]]]
+    frag_time: Dict[Any, float]
+
+    def __init__(self, addr: Tuple[str, int], on_payload: Callable[[Dict], None], on_error: Callable[[str], None]):
+        self.addr = addr
+        self.on_payload = on_payload
+        self.on_error = on_error
+        self.rtt = RTTEstimator()
+        self.waiters = {}
+        self.sent_at = {}
+        self.frags = {}
+        self.frag_time = {}
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.submit(self.loop.create_datagram_endpoint(
+            lambda: self, family=socket.AF_INET)).result()
+
+    def submit(self, coro: Coroutine) -> ThreadFuture:
+        '''Run a coroutine on the loop, from another thread'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def send(self, payload: bytes):
+        '''Send a datagram without waiting for a response, thread safe'''
+        self.loop.call_soon_threadsafe(self.transport.sendto, payload, self.addr)
+
+    def feed(self, raw: bytes):
+        '''Handle a response received by another thread'''
+        self.loop.call_soon_threadsafe(self.handle, raw)
+
+    async def request(self, payload: bytes, echo: Any, timeout: float) -> Dict:
+        '''Send a UDP request and return its response, TimeoutError after timeout'''
+        future = self.__expect(echo)
+        deadline = self.loop.time() + timeout
+        rto = self.rtt.rto
+
+        try:
+            self.sent_at[echo] = self.loop.time()
+            self.transport.sendto(payload, self.addr)
+
+            while True:
+                left = deadline - self.loop.time()
+                if left <= 0:
+                    raise TimeoutError('Timeout!')
+
+                done, _ = await asyncio.wait([future], timeout=min(rto, left))
+                if done:
+                    return future.result()
+
+                parts = self.frags.get(echo, None)
+                if parts is None:
+                    self.sent_at.pop(echo, None)
+                    self.transport.sendto(payload, self.addr)
+
+                elif self.loop.time() - self.frag_time[echo] >= rto:
+                    missing = [i for i, part in enumerate(parts) if part is None]
+                    self.frag_time[echo] = self.loop.time()
+                    self.transport.sendto(PayloadHelper.request_fragments(
+                        echo, missing[:RESEND_MAX], binary=is_binary(payload)), self.addr)
+
+                else:
+                    # fragments are still arriving
+                    continue
+
+                rto = min(rto * 2, RTO_MAX)
+
+        finally:
+            self.__forget(echo)
+
+    async def wait(self, echo: Any, timeout: float, send: Callable[[], None]) -> Dict:
+        '''Return the response of a request sent by send(), which may block'''
+        future = self.__expect(echo)
+
+        try:
+            self.loop.run_in_executor(None, send)
+            done, _ = await asyncio.wait([future], timeout=timeout)
+            if not done:
+                raise TimeoutError('Timeout!')
+            return future.result()
+
+        finally:
+            self.__forget(echo)
+
+    def __expect(self, echo: Any) -> asyncio.Future:
+        future = self.loop.create_future()
+        self.waiters[echo] = future
+        return future
+
+    def __forget(self, echo: Any):
+        self.waiters.pop(echo, None)
+        self.sent_at.pop(echo, None)
+        self.frags.pop(echo, None)
+        self.frag_time.pop(echo, None)
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.handle(data)
+
+    def error_received(self, exc: Exception):
+        # e.g. the server is not up yet, requests are sent again anyway
+        pass
+
+    def handle(self, raw: bytes):
+        '''Complete the request waiting for a response, acknowledge it'''
+        try:
+            payload = deserialize(raw)
+            echo = payload['echo']
+
+            sent = self.sent_at.pop(echo, None)
+            if sent is not None:
+                self.rtt.sample(self.loop.time() - sent)
+
+            if 'frag' in payload:  # fragment of a large response
+                self.__fragment(payload)
+                return
+
+            if 'code' in payload and 'msg' in payload:
+                reply = True
+                PayloadHelper.decompress(payload)
+                if 'batch' in payload:  # responses of a batch
+                    PayloadHelper.unpack_batch(payload)
+                self.on_payload(payload)
+
+            elif 'meta' in payload:  # meta
+                reply = payload.get('reply', False)
+
+            else:
+                self.on_error(f'Unrecognized payload: {payload}')
+                return
+
+            future = self.waiters.get(echo, None)
+            if future and not future.done():
+                future.set_result(payload)
+
+            if reply:
+                self.transport.sendto(PayloadHelper.request_meta(
+                    echo, False, binary=is_binary(raw)), self.addr)
+
+        except KeyError as e:
+            self.on_error(f'Bad payload: missing {e}')
+
+        except ForumBaseException as e:
+            self.on_error(e.msg)
+
+        except Exception as e:
+            self.on_error(f'Unknown error: {e}')
+
+    def __fragment(self, payload: Dict):
+        '''Collect response fragments, handle the response once complete'''
+        echo = payload['echo']
+        future = self.waiters.get(echo, None)
+        if future is None or future.done():
+            return
+
+        parts = self.frags.get(echo, None)
+        if parts is None:
+            parts = self.frags[echo] = [None] * int(payload['count'])
+
+        data = payload['data']
+        if isinstance(data, str):
+            data = b64decode(data)
+        parts[int(payload['frag'])] = data
+        self.frag_time[echo] = self.loop.time()
+
+        if None not in parts:
+            self.frags.pop(echo, None)
+            self.frag_time.pop(echo, None)
+            self.handle(b''.join(parts))
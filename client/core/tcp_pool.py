@@ -0,0 +1,213 @@
+import socket
+import threading
+from os import path
+from socket import socket as Socket
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .exceptions import FileIOError, ForumBaseException
+from .payload_helper import PayloadHelper
+from .utils import (json_deserializer, pack_frame, recv_file, recv_frame,
+                    send_file)
+
+# Connections kept open to the server
+POOL_CONNECTIONS = 2
+# Requests in flight on one connection before another one is opened
+PIPELINE_DEPTH = 8
+# Times a request is sent again on a new connection after its one broke
+TCP_RETRIES = 3
+CONNECT_TIMEOUT = 5
+
+
+class PendingRequest:
+    '''A request sent on a pooled connection, waiting for its response'''
+    echo: str
+    payload: bytes
+    # UPD streams the file from src, a successful DWN streams into the dst
+    # folder, under the name the response gives
+    src: Optional[str]
+    dst: Optional[str]
+    attempts = 0
+
+    def __init__(self, echo: str, payload: bytes, src: str = None, dst: str = None):
+        self.echo = echo
+        self.payload = payload
+        self.src = src
+        self.dst = dst
+
+
+class PooledConnection:
+    '''One TCP connection, requests are pipelined and matched by echo'''
+    sock: Socket
+    # in sending order
+    pending: Dict[str, PendingRequest]
+    # a request and its file chunks are sent as a whole
+    send_lock: threading.Lock
+    broken = False
+
+    def __init__(self, sock: Socket):
+        self.sock = sock
+        self.pending = {}
+        self.send_lock = threading.Lock()
+
+
+class TCPPool:
+    '''Keep TCP connections to the server alive and pipeline requests on them
+
+    The responses are passed to on_response, the content of a successful DWN
+    is written to its dst first. When a connection breaks its pending requests
+    are sent again on another one, up to TCP_RETRIES times. An UPD is not, the
+    server may have stored the file already, it fails instead.
+    '''
+    addr: Tuple[str, int]
+    on_response: Callable[[bytes], None]
+    on_error: Callable[[str], None]
+    conns: List[PooledConnection]
+    # connections being opened, counted against POOL_CONNECTIONS
+    connecting = 0
+    lock: threading.Lock
+    # notified once a connection is opened or failed to
+    opened: threading.Condition
+
+    def __init__(self, addr: Tuple[str, int], on_response: Callable[[bytes], None], on_error: Callable[[str], None]):
+        self.addr = addr
+        self.on_response = on_response
+        self.on_error = on_error
+        self.conns = []
+        self.lock = threading.Lock()
+        self.opened = threading.Condition(self.lock)
+
+    def request(self, echo: str, payload: bytes, src: str = None, dst: str = None):
+        '''Send a request, blocks while the file of an UPD is sent'''
+        self.__send(PendingRequest(echo, payload, src, dst))
+
+    def close(self):
+        with self.lock:
+            conns = self.conns
+            self.conns = []
+        for conn in conns:
+            conn.broken = True
+            self.__close_socket(conn.sock)
+
+    def __send(self, req: PendingRequest):
+        req.attempts += 1
+        try:
+            conn = self.__acquire(req)
+        except OSError as e:
+            self.__abort(req, f'TCP connect error: {e}')
+            return
+
+        try:
+            with conn.send_lock:
+                conn.sock.sendall(pack_frame(req.payload))
+                if req.src:
+                    send_file(conn.sock, req.src)
+
+        except OSError as e:
+            self.on_error(f'TCP send error: {e}')
+            # the request is sent again with the other pending ones
+            self.__fail(conn)
+
+    def __acquire(self, req: PendingRequest) -> PooledConnection:
+        '''Pick the least busy connection, open one if all are busy'''
+        with self.lock:
+            while True:
+                conn = min(self.conns, key=lambda c: len(c.pending), default=None)
+                full = len(self.conns) + self.connecting >= POOL_CONNECTIONS
+                if conn is not None and (len(conn.pending) < PIPELINE_DEPTH or full):
+                    conn.pending[req.echo] = req
+                    return conn
+                if not full:
+                    break
+                # every connection is still being opened
+                self.opened.wait()
+            self.connecting += 1
+
+        # connect without the lock, the receive threads keep taking it
+        try:
+            conn = self.__connect()
+        except OSError:
+            with self.lock:
+                self.connecting -= 1
+                self.opened.notify_all()
+            raise
+
+        with self.lock:
+            self.connecting -= 1
+            self.conns.append(conn)
+            conn.pending[req.echo] = req
+            self.opened.notify_all()
+
+        threading.Thread(target=self.__recv,
+                         args=(conn,), daemon=True).start()
+        return conn
+
+    def __connect(self) -> PooledConnection:
+        sock = socket.create_connection(self.addr, CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return PooledConnection(sock)
+
+    def __recv(self, conn: PooledConnection):
+        '''Thread receiving the responses of a connection'''
+        # a DWN whose content is being received, no longer pending
+        receiving = None
+        try:
+            while True:
+                raw = recv_frame(conn.sock)
+                payload = json_deserializer(raw)
+
+                with self.lock:
+                    req = conn.pending.pop(payload.get('echo', None), None)
+
+                if req and req.dst and payload.get('code', None) == 200:
+                    receiving = req
+                    name = path.basename(payload['name'])
+                    recv_file(conn.sock, path.join(req.dst, name),
+                              payload['size'])
+                    receiving = None
+
+                self.on_response(raw)
+
+        except (OSError, ForumBaseException) as e:
+            # closed by the server or a broken stream
+            if receiving:
+                self.__abort(receiving, f'TCP receive error: {e}')
+            elif not conn.broken and conn.pending:
+                self.on_error(f'TCP receive error: {e}')
+
+        self.__fail(conn)
+
+    def __fail(self, conn: PooledConnection):
+        '''Drop a connection, send its pending requests again'''
+        with self.lock:
+            if conn.broken:
+                return
+            conn.broken = True
+            if conn in self.conns:
+                self.conns.remove(conn)
+            pending = list(conn.pending.values())
+            conn.pending.clear()
+
+        self.__close_socket(conn.sock)
+
+        for req in pending:
+            if req.src:
+                self.__abort(req, 'Connection lost during the upload, '
+                             'check the thread before uploading again')
+            elif req.attempts <= TCP_RETRIES:
+                self.__send(req)
+            else:
+                self.__abort(req, f'TCP request {req.echo} failed')
+
+    def __abort(self, req: PendingRequest, msg: str):
+        '''Answer a request that is not sent again with an error'''
+        self.on_response(PayloadHelper.response_error(
+            FileIOError(503, msg), req.echo))
+
+    @staticmethod
+    def __close_socket(sock: Socket):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
@@ -1,13 +1,30 @@
 
 import json
-from base64 import b64encode
+import struct
 from json import JSONDecodeError
-from os import path
+from os import replace
+from socket import socket as Socket
 from time import time
 from typing import Dict, Tuple
 from uuid import uuid1
 
-from .exceptions import (FileTooLargeError, ForumBaseException, PayloadInvlidError)
+from .exceptions import ForumBaseException, PayloadInvlidError
+
+CHUNK_SIZE = 64 * 1024
+
+# Every frame on TCP is prefixed with its length, a zero length chunk ends a file
+FRAME_HEAD = struct.Struct('!I')
+
+# UDP responses larger than MAX_DATAGRAM are split into FRAGMENT_BYTES pieces,
+# which stay below a 1500 bytes MTU once base64 encoded
+MAX_DATAGRAM = 1400
+FRAGMENT_BYTES = 960
+
+# Compress response data of at least COMPRESS_THRESHOLD bytes once negotiated,
+# smaller responses are not worth the CPU time
+COMPRESS_ZLIB = 'zlib'
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
 
 
 def random_str():
@@ -18,16 +35,51 @@ def get_time():
     return int(time())
 
 
-def package_file(file_path: str) -> Tuple[str, str]:
-    name = path.basename(file_path)
+def pack_frame(data: bytes) -> bytes:
+    '''Prefix data with its length'''
+    return FRAME_HEAD.pack(len(data)) + data
 
-    with open(file_path, 'rb') as f:
-        data = f.read()
-        if len(data) >8000:
-            raise FileTooLargeError(413, 'File too large')
 
-    body = b64encode(data).decode('utf-8')
-    return (name, body)
+def recv_exact(sock: Socket, size: int) -> bytes:
+    '''Receive exactly size bytes'''
+    buf = bytearray()
+    while len(buf) < size:
+        data = sock.recv(min(size - len(buf), CHUNK_SIZE))
+        if not data:
+            raise ConnectionError('Connection closed by server')
+        buf += data
+    return bytes(buf)
+
+
+def recv_frame(sock: Socket) -> bytes:
+    '''Receive one length prefixed frame'''
+    size, = FRAME_HEAD.unpack(recv_exact(sock, FRAME_HEAD.size))
+    return recv_exact(sock, size)
+
+
+def send_file(sock: Socket, file_path: str):
+    '''Send a file as length prefixed chunks'''
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            sock.sendall(pack_frame(data))
+            if not data:
+                break
+
+
+def recv_file(sock: Socket, file_path: str, size: int):
+    '''Receive size bytes of raw content into a file'''
+    tmp_path = f'{file_path}.part'
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(tmp_path, 'wb') as f:
+        while size > 0:
+            count = sock.recv_into(view, min(size, CHUNK_SIZE))
+            if not count:
+                raise ConnectionError('Connection closed by server')
+            f.write(view[:count])
+            size -= count
+    replace(tmp_path, file_path)
 
 
 def log(msg: str, addr: Tuple[str, int] = None, error: bool = False):
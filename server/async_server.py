@@ -0,0 +1,198 @@
+import asyncio
+import os
+import sys
+from typing import Tuple
+
+from core.authenticator import EXPIRE_INTERVAL, Authenticator
+from core.forum_handler import ForumHandler
+from core.tcp_handler import TCPConnection, TCPHandler
+from core.udp_handler import UDPHandler
+from core.utils import log
+from core.worker_pool import WorkerPool
+from server import (DB_FILE, DURABILITY, FLUSH_INTERVAL, FLUSH_OPS,
+                    IO_BACKLOG, IO_WORKERS, LISTEN_BACKLOG, LISTEN_ON,
+                    RECV_BYTES)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    '''Feed UDP datagrams to UDPHandler'''
+    udp_handler: UDPHandler
+
+    def __init__(self, auth: Authenticator, forum: ForumHandler, pool: WorkerPool):
+        self.auth = auth
+        self.forum = forum
+        self.pool = pool
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        # the transport provides the sendto() used by UDPHandler
+        self.udp_handler = UDPHandler(
+            self.auth, self.forum, transport, self.pool)
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.udp_handler.handle_message(data, addr)
+
+    def error_received(self, exc: Exception):
+        log(f'UDP error: {exc}', None, True)
+
+
+class TCPStreamHandler:
+    '''Run TCPHandler on asyncio streams'''
+    tcp_handler: TCPHandler
+
+    def __init__(self, tcp_handler: TCPHandler):
+        self.tcp_handler = tcp_handler
+
+    async def __call__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock = writer.get_extra_info('socket')
+        addr = writer.get_extra_info('peername')
+        conn = TCPConnection(sock, addr)
+
+        # set when an I/O pool job of the connection is done
+        wake = asyncio.Event()
+        conn.ready = wake.set
+        read = None
+
+        try:
+            while not conn.closing:
+                # stop reading while an upload waits for the disk
+                if read is None and conn.want_read():
+                    read = asyncio.ensure_future(reader.read(RECV_BYTES))
+                waiter = asyncio.ensure_future(wake.wait())
+
+                await asyncio.wait([task for task in (read, waiter) if task],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                wake.clear()
+
+                if read and read.done():
+                    data = read.result()
+                    read = None
+                    if not data:
+                        break
+
+                    self.tcp_handler.handle_data(conn, data)
+
+                await self.flush(conn, writer)
+
+        except (ConnectionError, OSError):
+            log('TCP connection error', None, True)
+
+        except asyncio.CancelledError:
+            # server shutdown, clients keep their connections open
+            pass
+
+        finally:
+            if read:
+                read.cancel()
+            conn.release()
+            writer.close()
+
+    async def flush(self, conn: TCPConnection, writer: asyncio.StreamWriter):
+        '''Send queued responses and downloads'''
+        loop = asyncio.get_running_loop()
+
+        while conn.want_write():
+            if conn.outbuf:
+                writer.write(bytes(conn.outbuf))
+                conn.outbuf.clear()
+                await writer.drain()
+
+            elif conn.download:
+                if conn.download_left:
+                    await loop.sendfile(writer.transport, conn.download,
+                                        conn.download_offset, conn.download_left)
+                self.tcp_handler.finish_download(conn)
+
+
+async def serve(host: str, port: int):
+    loop = asyncio.get_running_loop()
+
+    # Init user authenticator
+    auth_file = os.path.abspath('./credentials.txt')
+    auth = Authenticator(auth_file)
+
+    # Password hashing and file I/O run on worker pools
+    pool = WorkerPool()
+    io_pool = WorkerPool(IO_WORKERS, IO_BACKLOG)
+    for p in (pool, io_pool):
+        loop.add_reader(p.fileno(), p.run_callbacks)
+
+    # Init forum handler
+    db_path = os.path.abspath(DB_FILE)
+    data_path = os.path.abspath('./data/')
+    forum = ForumHandler(db_path, data_path,
+                         DURABILITY, FLUSH_INTERVAL, FLUSH_OPS, io_pool)
+
+    try:
+        # Init UDP server
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: UDPProtocol(auth, forum, pool), local_addr=(host, port))
+            log(f'UDP server listening on {host}:{port}', None, False)
+        except OSError as s:
+            log(f'UDP server start error: {s}', None, True)
+            return
+
+        # Init TCP server
+        tcp_handler = TCPHandler(auth, forum, io_pool)
+        try:
+            server = await asyncio.start_server(
+                TCPStreamHandler(tcp_handler), host, port,
+                backlog=LISTEN_BACKLOG)
+            log(f'TCP server listening on {host}:{port}', None, False)
+        except OSError as s:
+            log(f'TCP server start error: {s}', None, True)
+            transport.close()
+            return
+
+        # Token expiry runs as a timer on the event loop
+        def expire_tokens():
+            auth.expire_tokens()
+            loop.call_later(EXPIRE_INTERVAL, expire_tokens)
+
+        loop.call_later(EXPIRE_INTERVAL, expire_tokens)
+
+        log('Wating for clients ...', None, False)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            transport.close()
+
+    finally:
+        for p in (pool, io_pool):
+            loop.remove_reader(p.fileno())
+            p.close()
+        forum.close()
+        log('Server shutdown ...', None, True)
+
+
+def main(host, port):
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+
+    try:
+        port = int((sys.argv[1:] or ['9999'])[0])
+        if port < 0 or port > 65535:
+            raise ValueError
+    except ValueError:
+        log('Usage: python3 async_server.py [port]', None, True)
+        log('Default port is 9999', None, True)
+        input('Press enter to exit...')
+        exit(1)
+
+    main(LISTEN_ON, port)
@@ -1,9 +1,12 @@
 
+import hashlib
+import heapq
+import hmac
+import os
 from os import path
-import time
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
-from core.utils import log, random_str
+from core.utils import log
 
 from .exceptions import (AuthenticationError, ParamsInValidError,
                          PasswordError, UserAlreadyExistsError,
@@ -12,6 +15,50 @@ from .utils import get_time
 
 TOKEN_TTL = 30
 
+# Seconds between two expire_tokens() calls of the asyncio server and of
+# the state process of --workers mode
+EXPIRE_INTERVAL = 1
+
+# Passwords are stored as scheme$iterations$salt$hash
+HASH_SCHEME = 'pbkdf2_sha256'
+HASH_ITERATIONS = 100000
+SALT_BYTES = 16
+
+# Replaced records in the credentials file before it is compacted
+COMPACT_MIN = 64
+
+# Random bytes of a token, binary payloads carry them raw
+TOKEN_BYTES = 16
+
+
+def hash_password(passwd: str, iterations: int = HASH_ITERATIONS, salt: bytes = None) -> str:
+    '''Salted hash of a password, slow on purpose, run it off the event loop'''
+    if salt is None:
+        salt = os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac(
+        'sha256', passwd.encode('utf-8'), salt, iterations)
+    return f'{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}'
+
+
+def verify_password(passwd: str, stored: str) -> Optional[str]:
+    '''Check a password against its stored hash
+
+    Return the record to keep, a fresh hash for a legacy plain text
+    password, or None if the password is wrong.
+    '''
+    if not stored.startswith(HASH_SCHEME + '$'):
+        if hmac.compare_digest(passwd.encode('utf-8'), stored.encode('utf-8')):
+            return hash_password(passwd)
+        return None
+
+    try:
+        _, iterations, salt, _ = stored.split('$')
+        record = hash_password(passwd, int(iterations), bytes.fromhex(salt))
+    except ValueError:
+        return None
+
+    return stored if hmac.compare_digest(record, stored) else None
+
 
 class Authenticator:
     '''Handler user login/register/logout'''
@@ -25,50 +72,89 @@ class Authenticator:
 
     token_ttl_dict: Dict[str, int] = {}
 
+    # (deadline, token) of every session, a renewed token is pushed back
+    # with its new deadline when the old one comes up
+    expiry_heap: List[Tuple[int, str]]
+
+    # records in the credentials file replaced by a later one
+    stale_records: int
+
     def __init__(self, file_path: str):
         self.file_path = file_path
+        self.expiry_heap = []
+        self.stale_records = 0
 
         self.__load_users()
-        self.__save_users()
+        if self.stale_records:
+            self.__save_users()
 
     def __load_users(self):
+        '''Read the credentials, a later record of a user replaces the earlier ones'''
         try:
             self.user_dict = {}
+            records = 0
 
             if not path.exists(self.file_path):
                 open(self.file_path, 'a', encoding='utf-8').close()
 
+            line = ''
             with open(self.file_path, 'r', encoding='utf-8') as f:
-                for line in f.readlines():
-                    if not line:
-                        continue
-
-                    seps = line.strip().split(' ')
+                for line in f:
+                    seps = line.split()
                     if len(seps) == 2:
                         user, passwd = seps
                         self.user_dict[user] = passwd
+                        records += 1
+
+            self.stale_records = records - len(self.user_dict)
+            if line and not line.endswith('\n'):
+                # rewrite before appending to an unterminated last line
+                self.stale_records += 1
 
         except Exception as e:
             print(e)
 
     def __save_users(self):
+        '''Rewrite the credentials with one record per user'''
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 for user, passwd in self.user_dict.items():
                     f.write(f'{user} {passwd}\n')
+            os.replace(tmp_path, self.file_path)
+            self.stale_records = 0
+
+        except Exception as e:
+            print(e)
+
+    def __append_user(self, user: str, passwd: str):
+        '''Store the record of a new or updated user at the end of the credentials'''
+        if user in self.user_dict:
+            self.stale_records += 1
+        self.user_dict[user] = passwd
+
+        # compact once most records are replaced ones
+        if self.stale_records > max(COMPACT_MIN, len(self.user_dict)):
+            self.__save_users()
+            return
+
+        try:
+            with open(self.file_path, 'a', encoding='utf-8') as f:
+                f.write(f'{user} {passwd}\n')
 
         except Exception as e:
             print(e)
 
     def __generate_token(self, user: str) -> str:
-        token = random_str()
+        token = os.urandom(TOKEN_BYTES).hex()
         self.user2token_dict[user] = token
         self.token2user_dict[token] = user
         self.token_ttl_dict[token] = get_time() + TOKEN_TTL
+        heapq.heappush(self.expiry_heap, (self.token_ttl_dict[token], token))
         return token
 
-    def login(self, user: str, passwd: str) -> str:
-        '''user login, return token if success'''
+    def check_login(self, user: str, passwd: str) -> str:
+        '''Checks before verifying the password, return the stored hash'''
         if not user:
             raise ParamsInValidError(400, 'Username can not be empty')
         
@@ -81,19 +167,38 @@ class Authenticator:
         elif user in self.user2token_dict:
             raise UserAlreadyLoginError(403, f'User {user} already login')
 
-        elif self.user_dict[user] != passwd:
-            if not passwd:
-                raise PasswordError(
-                    200, f'User {user} exists, please enter the password')
-            else:
-                raise PasswordError(403, f'Password error for user {user}')
+        elif not passwd:
+            raise PasswordError(
+                200, f'User {user} exists, please enter the password')
 
-        else:
-            token = self.__generate_token(user)
-            return token
+        return self.user_dict[user]
 
-    def register(self, user: str, passwd: str) -> str:
-        '''user register, return token if success'''
+    def finish_login(self, user: str, record: Optional[str]) -> str:
+        '''Login with the result of verify_password(), return token if success'''
+        # the state may have changed while the password was verified
+        if user not in self.user_dict:
+            raise UserNotExistsError(403, f'User {user} not exists')
+
+        elif user in self.user2token_dict:
+            raise UserAlreadyLoginError(403, f'User {user} already login')
+
+        elif record is None:
+            raise PasswordError(403, f'Password error for user {user}')
+
+        if record != self.user_dict[user]:
+            # upgrade a legacy plain text password
+            self.__append_user(user, record)
+
+        token = self.__generate_token(user)
+        return token
+
+    def login(self, user: str, passwd: str) -> str:
+        '''user login, return token if success'''
+        stored = self.check_login(user, passwd)
+        return self.finish_login(user, verify_password(passwd, stored))
+
+    def check_register(self, user: str, passwd: str):
+        '''Checks before hashing the password of a new user'''
         if not user:
             raise ParamsInValidError(400, 'Username can not be empty')
 
@@ -110,12 +215,20 @@ class Authenticator:
             else:
                 raise ParamsInValidError(400, 'Password too short')
 
-        else:
-            self.user_dict[user] = passwd
-            self.__save_users()
+    def finish_register(self, user: str, record: str) -> str:
+        '''Register with the result of hash_password(), return token if success'''
+        if user in self.user_dict:
+            raise UserAlreadyExistsError(403, f'User {user} already exists')
+
+        self.__append_user(user, record)
+
+        token = self.__generate_token(user)
+        return token
 
-            token = self.__generate_token(user)
-            return token
+    def register(self, user: str, passwd: str) -> str:
+        '''user register, return token if success'''
+        self.check_register(user, passwd)
+        return self.finish_register(user, hash_password(passwd))
 
     def logout(self, token: str) -> bool:
         '''user logout, return True if success'''
@@ -126,8 +239,8 @@ class Authenticator:
         self.token_ttl_dict.pop(token, None)
         return True
 
-    def auth(self, token: str) -> str:
-        '''user auth, return user if success'''
+    def auth(self, token: str, renew: bool = False) -> str:
+        '''user auth, return user if success, renew extends the session'''
         if not token or token not in self.token2user_dict:
             raise AuthenticationError(401, 'Unauthorized')
 
@@ -139,6 +252,9 @@ class Authenticator:
                 log(f'User {user} nolonger exists, logout.', None, True)
                 raise UserNotExistsError(403, f'User {user} not exists')
 
+            if renew:
+                self.token_ttl_dict[token] = get_time() + TOKEN_TTL
+
             return user
 
     def count_online(self) -> int:
@@ -151,22 +267,34 @@ class Authenticator:
 
         self.token_ttl_dict[token] = get_time() + TOKEN_TTL
 
-    def check_ttl(self):
-        while True:
-            expired = []
-            now = get_time()
-
-            for token, ttl in self.token_ttl_dict.items():
-                if now > ttl:
-                    expired.append(token)
-
-            for token in expired:
-                user = self.auth(token)
-                self.logout(token)
-                log(f'{user} \'s session expressed, auto logout!', None, True)
+    def next_expiry(self) -> Optional[int]:
+        '''Time at which expire_tokens() has work to do, None without sessions'''
+        if not self.expiry_heap:
+            return None
+        # a token expires once the time is past its deadline
+        return self.expiry_heap[0][0] + 1
+
+    def expire_tokens(self):
+        '''Logout every session whose token is expired'''
+        expired = []
+        now = get_time()
+
+        heap = self.expiry_heap
+        while heap and now > heap[0][0]:
+            _, token = heapq.heappop(heap)
+            ttl = self.token_ttl_dict.get(token, None)
+            if ttl is None:  # already logout
+                continue
+            if now > ttl:
+                expired.append(token)
+            else:
+                heapq.heappush(heap, (ttl, token))
 
-            if expired:
-                count = self.count_online()
-                log(f'Online users: {count}', None, False)
+        for token in expired:
+            user = self.auth(token)
+            self.logout(token)
+            log(f'{user} \'s session expressed, auto logout!', None, True)
 
-            time.sleep(TOKEN_TTL)
+        if expired:
+            count = self.count_online()
+            log(f'Online users: {count}', None, False)
@@ -81,6 +81,11 @@ class MessageNotExitsError(PostBaseException):
     ...
 
 
+class VersionExpiredError(PostBaseException):
+    '''VersionExpiredError'''
+    ...
+
+
 class FileNotExitsError(PostBaseException):
     '''FileNotExitsError'''
     ...
@@ -126,6 +131,11 @@ class ArgumentError(PostBaseException):
     ...
 
 
+class ServerBusyError(ForumBaseException):
+    '''ServerBusyError'''
+    ...
+
+
 class UnsupportedMethod(ForumBaseException):
     '''UnsupportedMethod'''
     ...
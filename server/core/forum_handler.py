@@ -1,159 +1,233 @@
 
-import json
-from base64 import b64decode
-from os import mkdir, path
-from typing import Dict, Tuple
+from os import makedirs, mkdir, path, replace
+from typing import Callable, Dict, List, Optional, Tuple
 
-from core.exceptions import (FileContentDecodeError, FileIOError,
+from core.exceptions import (ArgumentError, FileIOError,
                              FileNameDuplicateError, FileNotExitsError,
                              MessageNotExitsError, PermissionDeniedError,
-                             PostNotExitsError, PostTitleDuplicateError)
-from core.utils import package_file,remove_dir_recursive
+                             PostNotExitsError, PostTitleDuplicateError,
+                             VersionExpiredError)
+from core.utils import log, random_str, remove_dir_recursive
 
-from .models import ForumFile, ForumMessage, ForumModelEncoder, ForumThread
+from .models import ForumFile, ForumMessage, ForumThread
+from .ordinal_index import OrdinalIndex
+from .render_cache import Page, RenderCache
+from .storage import (DURABILITY_EVERY_OP, FLUSH_INTERVAL, FLUSH_OPS,
+                      ForumStorage, open_storage)
+from .worker_pool import WorkerPool
 
 
 class ForumHandler:
-    '''Handler forum'''
-    file_path: str
-    data_path: str
+    '''Handler forum
+
+    Threads and messages keep stable ids (pid, mid) that never change. Users
+    see contiguous numbers, which are mapped to ids by an OrdinalIndex, so a
+    deletion only leaves a tombstone instead of renumbering everything.
 
+    Every mutation is a record, see __apply. on_commit is called with the
+    sequence number of each committed record, replay() applies them to a
+    copy of the forum, e.g. in a worker process.
+    '''
+    file_path: Optional[str]
+    data_path: str
+    # folders of deleted threads waiting to be removed by the I/O pool
+    trash_path: str
+    io_pool: Optional[WorkerPool]
+    storage: ForumStorage
+    on_commit: Optional[Callable[[int, Dict], None]]
+    # records committed since the start
+    seq = 0
+
+    # both in ascending pid order
     pid_dict: Dict[int, ForumThread] = {}
     title_dict: Dict[str, ForumThread] = {}
+    thread_index: OrdinalIndex
+
+    # bumped by every change of the thread list
+    version = 0
+    render_cache: RenderCache
+    # thread versions restart with the process, tags carry the epoch
+    epoch: str
 
-    current_no = 0
+    current_no = 1
 
-    def __init__(self, file_path: str, data_path: str):
+    def __init__(self, file_path: Optional[str], data_path: str,
+                 durability: str = DURABILITY_EVERY_OP,
+                 flush_interval: float = FLUSH_INTERVAL, flush_ops: int = FLUSH_OPS,
+                 io_pool: WorkerPool = None,
+                 on_commit: Callable[[int, Dict], None] = None):
         self.file_path = file_path
         self.data_path = data_path
+        self.trash_path = path.normpath(data_path) + '.trash'
+        self.io_pool = io_pool
+        self.on_commit = on_commit
+        self.render_cache = RenderCache()
+        self.epoch = random_str()[:8]
+        self.storage = open_storage(
+            file_path, durability, flush_interval, flush_ops)
 
         self.__load_db()
-        self.__save_db()
+        self.storage.save(self.pid_dict)
+        self.storage.start()
 
     def __load_db(self):
-        try:
-            self.pid_dict = {}
-            self.title_dict = {}
-            max_no = 0
-
-            if not path.exists(self.file_path):
-                open(self.file_path, 'a', encoding='utf-8').close()
-
+        # a copy kept in memory only leaves the folders to the ForumHandler
+        # owning them, e.g. the state process of the workers
+        if self.file_path is not None:
             if not path.exists(self.data_path):
                 mkdir(self.data_path)
 
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                jd = json.load(f)
-                if not isinstance(jd, dict):
-                    jd = {}
-
-                for p_id, post in jd.items():
-                    try:
-                        p_id = int(p_id)
-
-                        if p_id > max_no:
-                            max_no = p_id
-
-                        p_title = post['title']
-                        p_author = post['author']
-                        p_next_mid = max(int(post['next_mid']), 1)
-                        p_next_fid = max(int(post['next_fid']), 1)
-                        p_messages = post['messages']
-                        p_files = post['files']
-
-                        if not isinstance(p_messages, dict):
-                            p_messages = {}
-
-                        if not isinstance(p_files, dict):
-                            p_files = {}
-
-                        messages = {}
-                        for m_id, reply in p_messages.items():
-                            try:
-                                m_id = int(m_id)
-                                if m_id > p_next_mid:
-                                    p_next_mid = m_id + 1
-                                r_author = reply['author']
-                                r_message = reply['message']
-                                messages[m_id] = ForumMessage(
-                                    m_id, r_author, r_message
-                                )
-
-                            except (KeyError, ValueError) as e:
-                                print(e)
-
-                        files = {}
-                        for f_id, file in p_files.items():
-                            try:
-                                f_id = int(f_id)
-                                if f_id > p_next_fid:
-                                    p_next_fid = f_id + 1
-                                f_uploader = file['uploader']
-                                f_name = file['name']
-                                files[f_id] = ForumFile(
-                                    f_id, f_uploader, f_name
-                                )
-
-                            except (KeyError, ValueError) as e:
-                                print(e)
-
-                        forum_post = ForumThread(
-                            p_id, p_title, p_author,
-                            p_next_mid, p_next_fid,
-                            messages, files
-                        )
-                        self.pid_dict[p_id] = forum_post
-                        self.title_dict[p_title] = forum_post
-
-                    except (KeyError, ValueError) as e:
-                        print(e)
-
-            self.current_no = max_no + 1
-
-        except Exception as e:
-            print(e)
-
-    def __save_db(self):
-        try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(
-                    self.pid_dict, f,
-                    cls=ForumModelEncoder,
-                    sort_keys=True,
-                    indent=2,
-                )
+            # left over by a shutdown before the pool removed them
+            if path.exists(self.trash_path):
+                remove_dir_recursive(self.trash_path)
+
+        self.pid_dict, records = self.storage.load()
+        self.title_dict = {}
+        for thread in self.pid_dict.values():
+            self.title_dict[thread.title] = thread
+        self.thread_index = OrdinalIndex(self.pid_dict.keys())
+
+        self.current_no = max(self.pid_dict.keys(), default=0) + 1
+
+        # replay mutation records on top of the snapshot
+        for record in records:
+            try:
+                self.__apply(record)
+            except (KeyError, ValueError) as e:
+                print(e)
+                break
+
+    def flush(self):
+        '''Write all pending records'''
+        self.storage.flush()
+
+    def close(self):
+        '''Persist everything that is still in memory'''
+        self.storage.close(self.pid_dict)
+
+    def __commit(self, record: Dict):
+        '''Apply a mutation record in memory and persist it'''
+        self.__apply(record)
+        self.storage.commit(record, self.pid_dict)
+
+        self.seq += 1
+        if self.on_commit:
+            self.on_commit(self.seq, record)
+
+    def replay(self, records: List[Dict]):
+        '''Apply records committed by another ForumHandler'''
+        for record in records:
+            self.__apply(record)
+
+    def export_records(self) -> Tuple[List[Dict], int]:
+        '''Records rebuilding the forum with replay(), and the current seq'''
+        records = []
+        for thread in self.pid_dict.values():
+            if thread.messages is None:
+                self.storage.load_thread(thread)
+
+            records.append({'op': 'CRT', 'pid': thread.pid,
+                            'title': thread.title, 'author': thread.author})
+            for msg in thread.messages.values():
+                records.append({'op': 'MSG', 'pid': thread.pid, 'mid': msg.mid,
+                                'author': msg.author, 'message': msg.message})
+            for file in thread.files.values():
+                records.append({'op': 'UPD', 'pid': thread.pid, 'fid': file.fid,
+                                'uploader': file.uploader, 'name': file.name})
+
+        return (records, self.seq)
+
+    def __apply(self, record: Dict):
+        op = record['op']
+
+        if op == 'CRT':
+            pid = record['pid']
+            title = record['title']
+            thread = ForumThread(pid, title, record['author'], 1, 1, {}, {})
+            self.pid_dict[pid] = thread
+            self.title_dict[title] = thread
+            self.thread_index.append(pid)
+            self.current_no = max(self.current_no, pid + 1)
+            self.version += 1
+
+        elif op == 'RMV':
+            thread = self.pid_dict.pop(record['pid'])
+            self.title_dict.pop(thread.title, None)
+            self.thread_index.remove(thread.pid)
+            self.version += 1
+
+        elif op == 'MSG':
+            thread = self.pid_dict[record['pid']]
+            mid = record['mid']
+            thread.messages[mid] = ForumMessage(
+                mid, record['author'], record['message'])
+            thread.index.append(mid)
+            thread.next_mid = mid + 1
+            thread.log_change(
+                f'MSG {str(len(thread.index)).ljust(2)} | {record["author"]}: {record["message"]}')
+
+        elif op == 'EDT':
+            thread = self.pid_dict[record['pid']]
+            msg = thread.messages[record['mid']]
+            msg.message = record['message']
+            no = thread.index.ordinal(msg.mid)
+            thread.log_change(
+                f'EDT {str(no).ljust(2)} | {msg.author}: {msg.message}')
+
+        elif op == 'DLT':
+            thread = self.pid_dict[record['pid']]
+            no = thread.index.ordinal(record['mid'])
+            thread.messages.pop(record['mid'])
+            thread.index.remove(record['mid'])
+            thread.log_change(f'DLT {no}')
+
+        elif op == 'UPD':
+            thread = self.pid_dict[record['pid']]
+            fid = record['fid']
+            thread.add_file(ForumFile(fid, record['uploader'], record['name']))
+            thread.next_fid = fid + 1
+            thread.log_change(
+                f'UPD {str(fid).ljust(2)} | {record["uploader"]}: {record["name"]}')
 
-        except Exception as e:
-            print(e)
+        else:
+            raise ValueError(f'Unknown record op {op}')
 
     def __fetch_thread(self, title: str = None) -> ForumThread:
+        thread = None
         if title and title in self.title_dict:
-            return self.title_dict[title]
+            thread = self.title_dict[title]
 
-        try:
-            pid = int(title)
-            if pid and pid in self.pid_dict:
-                return self.pid_dict[pid]
-        except ValueError:
-            pass
+        else:
+            try:
+                pid = self.thread_index.find(int(title))
+                if pid is not None:
+                    thread = self.pid_dict[pid]
+            except (TypeError, ValueError):
+                pass
+
+        if thread:
+            if thread.messages is None:
+                self.storage.load_thread(thread)
+            return thread
 
         raise PostNotExitsError(404, f'Thread {title} not found')
 
     def __fetch_thread_message(self, title: str, mid: int) -> Tuple[ForumThread, ForumMessage]:
         thread = self.__fetch_thread(title)
 
-        if mid in thread.messages:
-            return (thread, thread.messages[mid])
+        sid = thread.index.find(mid)
+        if sid is not None:
+            return (thread, thread.messages[sid])
 
         raise MessageNotExitsError(
             404, f'Message id {mid} in thread {title} not found')
 
-    def __fetch_thread_file(self, title: str, name: str) -> ForumFile:
+    def __fetch_thread_file(self, title: str, name: str) -> Tuple[ForumThread, ForumFile]:
         thread = self.__fetch_thread(title)
 
-        for file in thread.files.values():
-            if file.name == name or file.fid == name:
-                return file
+        file = thread.find_file(name)
+        if file:
+            return (thread, file)
 
         raise FileNotExitsError(
             404, f'File {name} in thread {title} not found')
@@ -163,14 +237,8 @@ class ForumHandler:
             raise PostTitleDuplicateError(
                 400, f'Thread {title} is already exist')
 
-        pid = self.current_no
-        new_post = ForumThread(pid, title, user, 1, 1, {}, {})
-
-        self.current_no += 1
-        self.pid_dict[pid] = new_post
-        self.title_dict[title] = new_post
-
-        self.__save_db()
+        self.__commit({'op': 'CRT', 'pid': self.current_no,
+                       'title': title, 'author': user})
 
         return f'Thread {title} created'
 
@@ -181,64 +249,120 @@ class ForumHandler:
             raise PermissionDeniedError(
                 403, 'The thread belongs to another user and cannot be edited')
 
-        self.pid_dict.pop(thread.pid, None)
-        self.title_dict.pop(thread.title, None)
-
-        next_fid = 1
-        pid_dict = {}
-        title_dict = {}
-        for i, th in enumerate(self.pid_dict.values(), 1):
-            th.pid = i
-            pid_dict[i] = th
-            title_dict[th.title] = th
-            next_fid += 1
-
-        self.pid_dict = pid_dict
-        self.title_dict = title_dict
-        self.current_no = next_fid
-
-        self.__save_db()
-        
-        fold_path = path.join(self.data_path, title)
+        self.__commit({'op': 'RMV', 'pid': thread.pid})
+
+        fold_path = path.join(self.data_path, thread.title)
         if path.exists(fold_path):
-            remove_dir_recursive(fold_path)
+            self.__remove_dir(fold_path)
 
         return f'Thread {thread.title} deleted'
 
-    def list_threads(self) -> str:
-        lines = ['ID | Thread Title | Author']
+    def __remove_dir(self, fold_path: str):
+        '''Move a folder to the trash and remove it on the I/O pool'''
+        if self.io_pool is None:
+            remove_dir_recursive(fold_path)
+            return
 
-        ids = sorted(self.pid_dict.keys())
+        trash = path.join(self.trash_path, random_str())
+        try:
+            makedirs(self.trash_path, exist_ok=True)
+            replace(fold_path, trash)
+        except OSError:
+            remove_dir_recursive(fold_path)
+            return
 
-        if not ids:
-            lines.append('There is no thread')
-        else:
-            for pid in ids:
-                post = self.pid_dict.get(pid, None)
-                if not post:
-                    continue
-                lines.append(
-                    f'{str(pid).ljust(2)} | {post.title.ljust(12)} | {post.author}')
+        def removed(_, error: Optional[BaseException]):
+            if error:
+                log(f'Can not remove {trash}: {error}', None, True)
+
+        if not self.io_pool.submit(removed, remove_dir_recursive, trash):
+            remove_dir_recursive(trash)
+
+    def list_threads(self, cursor: int = 0, limit: int = 0) -> Tuple[str, Optional[int]]:
+        '''List up to limit threads (0 for all) after cursor, a thread id
+
+        Return the listing and the cursor of the next page, None on the last page
+        '''
+        key = ('LST', self.version, cursor, limit)
+        page = self.render_cache.get(key)
+        if page is None:
+            page = self.__render_threads(cursor, limit)
+            self.render_cache.put(key, page)
+        return page
+
+    def __render_threads(self, cursor: int, limit: int) -> Page:
+        self.thread_index.compact_if_sparse()
+
+        first, pids, cursor_next = self.thread_index.page(cursor, limit)
+
+        lines = []
+        if not cursor:
+            lines.append('ID | Thread Title | Author')
+            if not pids:
+                lines.append('There is no thread')
+
+        for no, pid in enumerate(pids, first):
+            post = self.pid_dict[pid]
+            lines.append(
+                f'{str(no).ljust(2)} | {post.title.ljust(12)} | {post.author}')
 
-        return '\n'.join(lines)
+        return ('\n'.join(lines), cursor_next)
 
-    def read_thread(self, title: str) -> str:
+    def read_thread(self, title: str, cursor: int = 0, limit: int = 0) -> Tuple[str, Optional[int], str]:
+        '''Read up to limit messages (0 for all) after cursor, a message id
+
+        Files are listed on the last page. Return the text, the cursor of the
+        next page (None on the last page) and the version to pass to
+        read_thread_since()
+        '''
         thread = self.__fetch_thread(title)
 
-        lines = ['ID | Message']
+        key = ('RDT', thread.pid, thread.version, cursor, limit)
+        page = self.render_cache.get(key)
+        if page is None:
+            page = self.__render_thread(thread, cursor, limit)
+            self.render_cache.put(key, page)
+        return page + (f'{self.epoch}.{thread.version}',)
 
-        msgs = thread.messages.values()
+    def read_thread_since(self, title: str, version: str) -> Tuple[str, str]:
+        '''Changes of a thread after version, one line per MSG/EDT/DLT/UPD
 
-        if not msgs:
-            lines.append('There is no message in this thread')
-        else:
-            for msg in msgs:
-                lines.append(
-                    f'{str(msg.mid).ljust(2)} | {msg.author}: {msg.message}')
+        Numbers are those at the time of each change, so applying the lines
+        in order to the thread as read at version gives the current thread.
+        Return the changes and the current version.
+        '''
+        thread = self.__fetch_thread(title)
+
+        changes = None
+        epoch, _, number = version.partition('.')
+        if epoch == self.epoch and number.isdigit():
+            changes = thread.changes_since(int(number))
+
+        if changes is None:
+            raise VersionExpiredError(
+                410, f'Version {version} of thread {title} expired, read the whole thread')
+
+        return ('\n'.join(changes), f'{self.epoch}.{thread.version}')
+
+    def __render_thread(self, thread: ForumThread, cursor: int, limit: int) -> Page:
+        thread.index.compact_if_sparse()
+
+        first, mids, cursor_next = thread.index.page(cursor, limit)
+
+        lines = []
+        if not cursor:
+            lines.append('ID | Message')
+            if not mids:
+                lines.append('There is no message in this thread')
+
+        for no, mid in enumerate(mids, first):
+            msg = thread.messages[mid]
+            lines.append(
+                f'{str(no).ljust(2)} | {msg.author}: {msg.message}')
 
         files = thread.files.values()
 
-        if files:
+        if files and cursor_next is None:
             lines.append('')
             lines.append('ID | File Name')
 
@@ -246,17 +370,13 @@ class ForumHandler:
                 lines.append(
                     f'{str(file.fid).ljust(2)} | {file.uploader}: {file.name}')
 
-        return '\n'.join(lines)
+        return ('\n'.join(lines), cursor_next)
 
     def post_message(self, title: str, message: str, user: str) -> str:
         thread = self.__fetch_thread(title)
 
-        mid = thread.next_mid
-        msg = ForumMessage(mid, user, message)
-        thread.messages[mid] = msg
-        thread.next_mid += 1
-
-        self.__save_db()
+        self.__commit({'op': 'MSG', 'pid': thread.pid, 'mid': thread.next_mid,
+                       'author': user, 'message': message})
 
         return f'Message posted to {thread.title} thread'
 
@@ -267,10 +387,8 @@ class ForumHandler:
             raise PermissionDeniedError(
                 403, f'The thread belongs to another user and cannot be edited')
 
-        msg.message = message
-        thread.messages[mid] = msg
-
-        self.__save_db()
+        self.__commit({'op': 'EDT', 'pid': thread.pid, 'mid': msg.mid,
+                       'message': message})
 
         return 'The message has been edited'
 
@@ -281,64 +399,46 @@ class ForumHandler:
             raise PermissionDeniedError(
                 403, f'The thread belongs to another user and cannot be edited')
 
-        thread.messages.pop(msg.mid, None)
-
-        next_mid = 1
-        messages = {}
-        for i, msg in enumerate(thread.messages.values(), 1):
-            msg.mid = i
-            messages[i] = msg
-            next_mid += 1
-
-        thread.messages = messages
-        thread.next_mid = next_mid
-
-        self.__save_db()
+        self.__commit({'op': 'DLT', 'pid': thread.pid, 'mid': msg.mid})
 
         return 'The message has been deleted'
 
-    def upload_file(self, title: str, file_name: str, content: str, user: str) -> str:
+    def prepare_upload(self, title: str, file_name: str) -> str:
+        '''Check an upload, return the partial file path to stream the content into'''
         thread = self.__fetch_thread(title)
 
-        for file in thread.files.values():
-            if file_name == file.name:
-                raise FileNameDuplicateError(
-                    400, f'File {file_name} is already exist')
+        if not file_name or file_name in ('.', '..') or path.basename(file_name) != file_name:
+            raise ArgumentError(400, f'File name {file_name} is invalid')
 
-        try:
-            raw = b64decode(content.encode('utf-8'))
-        except Exception:
-            raise FileContentDecodeError(
-                400, f'File {file_name} content decode error')
+        if file_name in thread.file_names:
+            raise FileNameDuplicateError(
+                400, f'File {file_name} is already exist')
+
+        # the thread folder is created along with the file
+        fold_path = path.join(self.data_path, thread.title)
+        return path.join(fold_path, f'.{file_name}.{random_str()}.part')
 
-        fold_path = path.join(self.data_path, title)
-        if not path.exists(fold_path):
-            mkdir(fold_path)
+    def upload_file(self, title: str, file_name: str, part_path: str, user: str) -> str:
+        '''Move a fully received partial file in place'''
+        thread = self.__fetch_thread(title)
 
-        file_path = path.join(fold_path, file_name)
+        if file_name in thread.file_names:
+            raise FileNameDuplicateError(
+                400, f'File {file_name} is already exist')
+
+        file_path = path.join(self.data_path, thread.title, file_name)
         try:
-            with open(file_path, 'wb') as f:
-                f.write(raw)
+            replace(part_path, file_path)
         except Exception:
             raise FileIOError(500, f'Can not write file {file_name}')
 
-        fid = thread.next_fid
-        file = ForumFile(fid, user, file_name)
-        thread.files[fid] = file
-        thread.next_fid += 1
-
-        self.__save_db()
-
-        return f'File {file_name} uploaded to {title} thread'
+        self.__commit({'op': 'UPD', 'pid': thread.pid, 'fid': thread.next_fid,
+                       'uploader': user, 'name': file_name})
 
-    def download_file(self, title: str, file_name: str) -> str:
-        file = self.__fetch_thread_file(title, file_name)
+        return f'File {file_name} uploaded to {thread.title} thread'
 
-        file_path = path.join(self.data_path, title, file.name)
-
-        try:
-            name, body = package_file(file_path)
-        except Exception:
-            raise FileIOError(404, f'Can not read file {file_name}')
+    def download_file(self, title: str, file_name: str) -> Tuple[str, str]:
+        '''Return path and name of the file to stream, it may be asked for by id'''
+        thread, file = self.__fetch_thread_file(title, file_name)
 
-        return body
+        return (path.join(self.data_path, thread.title, file.name), file.name)
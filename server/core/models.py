@@ -1,6 +1,13 @@
 
+from collections import deque
+from itertools import islice
 from json import JSONEncoder
-from typing import Dict
+from typing import Deque, Dict, List, Optional
+
+from .ordinal_index import OrdinalIndex
+
+# Changes kept per thread for delta reads
+CHANGE_LOG_SIZE = 256
 
 
 class ForumMessage:
@@ -33,6 +40,13 @@ class ForumThread:
     next_fid: int
     messages: Dict[int, ForumMessage]
     files: Dict[int, ForumFile]
+    file_names: Dict[str, ForumFile]
+    index: OrdinalIndex
+
+    # bumped by every change of messages or files
+    version = 0
+    # rendered changes, the last one is at version
+    changes: Deque[str]
 
     def __init__(self, pid: int, title: str, author: str, next_mid: int, next_fid: int, messages: Dict[int, ForumMessage], files: Dict[int, ForumFile]) -> None:
         self.pid = pid
@@ -40,8 +54,46 @@ class ForumThread:
         self.author = author
         self.next_mid = next_mid
         self.next_fid = next_fid
+        self.messages = None
+        self.files = None
+        self.file_names = None
+        self.index = None
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE)
+
+        if messages is not None:
+            self.load(messages, files)
+
+    def load(self, messages: Dict[int, ForumMessage], files: Dict[int, ForumFile]):
+        '''Set messages and files, messages must be in ascending mid order'''
         self.messages = messages
         self.files = files
+        self.file_names = {file.name: file for file in files.values()}
+        self.index = OrdinalIndex(messages.keys())
+
+    def log_change(self, change: str):
+        self.version += 1
+        self.changes.append(change)
+
+    def changes_since(self, version: int) -> Optional[List[str]]:
+        '''Changes after version, None if they are no longer logged'''
+        count = self.version - version
+        if count < 0 or count > len(self.changes):
+            return None
+        return list(islice(reversed(self.changes), count))[::-1]
+
+    def add_file(self, file: ForumFile):
+        self.files[file.fid] = file
+        self.file_names[file.name] = file
+
+    def find_file(self, name: str) -> ForumFile:
+        '''Look up a file by name, then by file id, None if not found'''
+        file = self.file_names.get(name)
+        if file is None:
+            try:
+                file = self.files.get(int(name))
+            except ValueError:
+                pass
+        return file
 
 
 class ForumModelEncoder(JSONEncoder):
@@ -0,0 +1,125 @@
+from bisect import bisect_right
+from typing import Iterable, List, Optional, Tuple
+
+# Compact once tombstones outnumber live ids and this minimum
+COMPACT_MIN = 64
+
+
+class OrdinalIndex:
+    '''Map stable ids to contiguous 1-based ordinals
+
+    Ids are appended in ascending order and removing one only leaves a
+    tombstone. A Fenwick tree over the slots counts live ids, so append,
+    remove, ordinal() and find() are O(log n). compact() drops the
+    tombstones in O(n).
+    '''
+    ids: List[int]
+    alive: List[bool]
+    tree: List[int]
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.__build(sorted(ids))
+
+    def __build(self, ids: List[int]):
+        size = len(ids)
+
+        self.ids = ids
+        self.alive = [True] * size
+        self.slot = {sid: i for i, sid in enumerate(ids, 1)}
+        self.count = size
+
+        tree = [0] * (size + 1)
+        for i in range(1, size + 1):
+            tree[i] += 1
+            j = i + (i & -i)
+            if j <= size:
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __prefix(self, i: int) -> int:
+        total = 0
+        tree = self.tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def append(self, sid: int):
+        '''Add an id greater than every id in the index'''
+        self.ids.append(sid)
+        self.alive.append(True)
+        size = len(self.ids)
+        self.slot[sid] = size
+        self.count += 1
+
+        # the new node covers (size - lowbit, size]
+        low = size - (size & -size)
+        self.tree.append(1 + self.__prefix(size - 1) - self.__prefix(low))
+
+    def remove(self, sid: int):
+        '''Tombstone an id, the ordinals after it shift down by one'''
+        i = self.slot.pop(sid)
+        self.alive[i - 1] = False
+        self.count -= 1
+
+        tree = self.tree
+        size = len(tree) - 1
+        while i <= size:
+            tree[i] -= 1
+            i += i & -i
+
+    def ordinal(self, sid: int) -> int:
+        '''Ordinal of a live id'''
+        return self.__prefix(self.slot[sid])
+
+    def find(self, ordinal: int) -> Optional[int]:
+        '''Id shown as ordinal, None if out of range'''
+        if ordinal < 1 or ordinal > self.count:
+            return None
+
+        tree = self.tree
+        size = len(tree) - 1
+        pos = 0
+        step = 1 << (size.bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt <= size and tree[nxt] < ordinal:
+                pos = nxt
+                ordinal -= tree[nxt]
+            step >>= 1
+
+        return self.ids[pos]
+
+    def page(self, after: int, limit: int) -> Tuple[int, List[int], Optional[int]]:
+        '''Up to limit ids greater than after, all of them if limit is 0
+
+        Return the ordinal of the first id, the ids and the after value of
+        the next page, None if there are no more ids.
+        '''
+        start = bisect_right(self.ids, after)
+        first = self.__prefix(start) + 1
+
+        ids = []
+        alive = self.alive
+        for i in range(start, len(self.ids)):
+            if alive[i]:
+                if limit and len(ids) == limit:
+                    return (first, ids, ids[-1])
+                ids.append(self.ids[i])
+
+        return (first, ids, None)
+
+    @property
+    def tombstones(self) -> int:
+        return len(self.ids) - self.count
+
+    def compact(self):
+        '''Drop tombstones'''
+        self.__build([sid for sid, alive in zip(self.ids, self.alive) if alive])
+
+    def compact_if_sparse(self):
+        if self.tombstones > max(COMPACT_MIN, self.count):
+            self.compact()
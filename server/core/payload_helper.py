@@ -1,66 +1,177 @@
 
+import zlib
+from base64 import b64decode, b64encode
+from typing import Dict, List
+
 from .exceptions import ForumBaseException
-from .utils import json_serializer
+from .utils import (COMPRESS_LEVEL, COMPRESS_THRESHOLD, FRAGMENT_BYTES,
+                    json_serializer)
+from .wire import deserialize, encode, encode_heartbeat
+
+
+def serialize(jd: dict, binary: bool = False) -> bytes:
+    '''Encode a payload as JSON or, if negotiated, in the binary format'''
+    return encode(jd) if binary else json_serializer(jd)
 
 
 class PayloadHelper:
+    '''Build payloads, UDP payloads are binary if binary is set'''
+
     @staticmethod
-    def request_auth(user: str, passwd: str, login: bool = True, echo: str = ''):
+    def request_auth(user: str, passwd: str, login: bool = True, echo: str = '', binary: bool = False):
         '''Authentication request'''
         jd = {'cmd': 'LOG' if login else 'REG',
               'user': user, 'passwd': passwd, 'echo': echo}
-        data = json_serializer(jd)
+        data = serialize(jd, binary)
         return data
 
     @staticmethod
-    def response_auth(code: int, token: str, msg: str = 'OK', echo: str = ''):
+    def response_auth(code: int, token: str, msg: str = 'OK', echo: str = '', binary: bool = False):
         '''Authentication response'''
         jd = {'code': code, 'msg': msg, 'token': token,
               'echo': echo}
-        data = json_serializer(jd)
+        data = serialize(jd, binary)
         return data
 
     @staticmethod
-    def request_command(cmd: str, token: str, args: str = None, echo: str = ''):
-        '''Command request'''
+    def request_command(cmd: str, token: str, args: str = None, echo: str = '', cursor: int = None, limit: int = None, since: str = None, compress: bool = False, binary: bool = False):
+        '''Command request
+
+        LST and RDT return pages of limit items after cursor, RDT with since
+        returns the changes after that version. compress accepts a compressed
+        response.
+        '''
         jd = {'cmd': cmd, 'args': args or '', 'token': token, 'echo': echo}
-        data = json_serializer(jd)
+        if compress:
+            jd['z'] = 1
+        if limit:
+            jd['cursor'] = cursor or 0
+            jd['limit'] = limit
+        if since:
+            jd['since'] = since
+        data = serialize(jd, binary)
         return data
 
     @staticmethod
-    def response_command(code: int, data: str = None, msg: str = 'OK', echo: str = ''):
-        '''Command response'''
+    def response_command(code: int, data: str = None, msg: str = 'OK', echo: str = '', cursor: int = None, version: str = None, compress: bool = False, binary: bool = False):
+        '''Command response, cursor is set if there is a next page
+
+        With compress, data of at least COMPRESS_THRESHOLD bytes is sent
+        zlib compressed and z is set.
+        '''
         jd = {'code': code, 'msg': msg, 'data': data, 'echo': echo}
-        data = json_serializer(jd)
+        if compress and data and len(data) >= COMPRESS_THRESHOLD:
+            raw = data.encode('utf-8')
+            packed = zlib.compress(raw, COMPRESS_LEVEL)
+            if len(packed) < len(raw):
+                jd['data'] = packed if binary else b64encode(
+                    packed).decode('ascii')
+                jd['z'] = 1
+        if cursor is not None:
+            jd['cursor'] = cursor
+        if version is not None:
+            jd['version'] = version
+        data = serialize(jd, binary)
+        return data
+
+    @staticmethod
+    def request_heartbeat(token: str):
+        '''Compact heartbeat of a binary client, HEART commands do the same in JSON'''
+        return encode_heartbeat(token)
+
+    @staticmethod
+    def request_batch(token: str, commands: List[bytes], echo: str = '', binary: bool = False):
+        '''Batch request, carries command requests which all use its token'''
+        if not binary:
+            commands = [command.decode('utf-8') for command in commands]
+        jd = {'cmd': 'BATCH', 'batch': commands, 'token': token, 'echo': echo}
+        data = serialize(jd, binary)
         return data
 
     @staticmethod
-    def response_error(err: ForumBaseException, echo: str = ''):
+    def response_batch(responses: List[bytes], echo: str = '', binary: bool = False):
+        '''Batch response, carries the responses of the commands in order'''
+        if not binary:
+            responses = [response.decode('utf-8') for response in responses]
+        jd = {'code': 200, 'msg': 'OK', 'batch': responses, 'echo': echo}
+        data = serialize(jd, binary)
+        return data
+
+    @staticmethod
+    def unpack_batch(payload: Dict):
+        '''Decode the command responses of a batch response in place'''
+        responses = []
+        for raw in payload['batch']:
+            if isinstance(raw, str):
+                raw = raw.encode('utf-8')
+            response = deserialize(raw)
+            PayloadHelper.decompress(response)
+            responses.append(response)
+        payload['batch'] = responses
+
+    @staticmethod
+    def response_error(err: ForumBaseException, echo: str = '', binary: bool = False):
         '''Error response'''
         name = err.__doc__ or str(err.__class__)
         jd = {'code': err.code, 'msg': err.msg, 'error': name, 'echo': echo}
-        data = json_serializer(jd)
+        data = serialize(jd, binary)
         return data
 
     @staticmethod
-    def request_meta(echo: str = '', reply: bool = False):
-        '''Metadata request'''
+    def request_meta(echo: str = '', reply: bool = False, proto: str = None, compress: str = None, binary: bool = False):
+        '''Metadata request, advertises or accepts the binary format and compression'''
         jd = {'meta': True, 'echo': echo, 'reply': reply}
-        data = json_serializer(jd)
+        if proto:
+            jd['proto'] = proto
+        if compress:
+            jd['compress'] = compress
+        data = serialize(jd, binary)
+        return data
+
+    @staticmethod
+    def decompress(payload: Dict):
+        '''Restore the data of a compressed command response in place'''
+        if payload.get('z', None):
+            data = payload['data']
+            if isinstance(data, str):
+                data = b64decode(data)
+            payload['data'] = zlib.decompress(data).decode('utf-8')
+            del payload['z']
+
+    @staticmethod
+    def response_fragments(data: bytes, echo: str = '', binary: bool = False) -> List[bytes]:
+        '''Split an oversized UDP response into fragments'''
+        count = (len(data) + FRAGMENT_BYTES - 1) // FRAGMENT_BYTES
+        fragments = []
+        for i in range(count):
+            part = data[i * FRAGMENT_BYTES:(i + 1) * FRAGMENT_BYTES]
+            if not binary:
+                part = b64encode(part).decode('ascii')
+            jd = {'frag': i, 'count': count, 'data': part, 'echo': echo}
+            fragments.append(serialize(jd, binary))
+        return fragments
+
+    @staticmethod
+    def request_fragments(echo: str, missing: List[int], binary: bool = False):
+        '''Ask for the missing fragments of a response'''
+        jd = {'resend': missing, 'echo': echo}
+        data = serialize(jd, binary)
         return data
 
     @staticmethod
-    def request_file(name: str, body: str, title: str, token: str,  upload: bool = True, echo: str = ''):
+    def request_file(name: str, size: int, title: str, token: str,  upload: bool = True, echo: str = ''):
+        '''File request header, UPD is followed by the file chunks'''
         jd = {'cmd': 'UPD' if upload else 'DWN',
               'title': title,
-              'name': name, 'body': body,
+              'name': name, 'size': size,
               'token': token, 'echo': echo}
         data = json_serializer(jd)
         return data
 
     @staticmethod
-    def response_file(code: int = 200, msg: str = 'OK', name: str = '', body: str = '', echo: str = ''):
+    def response_file(code: int = 200, msg: str = 'OK', name: str = '', size: int = 0, echo: str = ''):
+        '''File response header, a successful DWN is followed by size raw bytes'''
         jd = {'code': code, 'msg': msg, 'name': name,
-              'body': body,  'echo': echo}
+              'size': size,  'echo': echo}
         data = json_serializer(jd)
         return data
@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+# Total characters of cached text
+RENDER_CACHE_CHARS = 4 * 1024 * 1024
+
+Page = Tuple[str, Optional[int]]
+
+
+class RenderCache:
+    '''LRU cache of rendered pages, bounded by the total length of their text
+
+    Keys contain the version of what was rendered, so entries never need
+    invalidation, stale ones are simply evicted.
+    '''
+    entries: 'OrderedDict[Hashable, Page]'
+    size: int
+    limit: int
+
+    def __init__(self, limit: int = RENDER_CACHE_CHARS):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.limit = limit
+
+    def get(self, key: Hashable) -> Optional[Page]:
+        page = self.entries.get(key)
+        if page is not None:
+            self.entries.move_to_end(key)
+        return page
+
+    def put(self, key: Hashable, page: Page):
+        if len(page[0]) > self.limit:
+            return
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0])
+
+        self.entries[key] = page
+        self.size += len(page[0])
+
+        while self.size > self.limit:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old[0])
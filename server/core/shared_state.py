@@ -0,0 +1,273 @@
+import heapq
+import json
+import sqlite3
+import time
+from multiprocessing.managers import BaseManager
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from .authenticator import EXPIRE_INTERVAL, TOKEN_TTL, Authenticator
+from .exceptions import AuthenticationError
+from .forum_handler import ForumHandler
+from .utils import get_time
+
+# A worker writes a renewed deadline only once it moved this many seconds,
+# so active sessions do not write the store on every request
+RENEW_SLACK = 5
+
+# Objects living in the state process
+_state = {}
+
+
+class SharedStore:
+    '''SQLite database in WAL mode shared by the state and worker processes
+
+    The state process writes sessions and the forum records it commits,
+    workers read them without going through the state process. Every
+    process opens its own connection.
+    '''
+    db: sqlite3.Connection
+    lock: Lock
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            user TEXT NOT NULL,
+            deadline INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS records (
+            seq INTEGER PRIMARY KEY,
+            record TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, file_path: str):
+        self.db = sqlite3.connect(file_path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # the store is reset on every start, nothing needs to survive a crash
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.executescript(self.SCHEMA)
+        self.lock = Lock()
+
+    def reset(self):
+        '''Drop the sessions and records of a previous run'''
+        with self.lock:
+            self.db.execute('DELETE FROM sessions')
+            self.db.execute('DELETE FROM records')
+
+    def add_session(self, token: str, user: str, deadline: int):
+        with self.lock:
+            self.db.execute('INSERT INTO sessions VALUES (?, ?, ?)',
+                            (token, user, deadline))
+
+    def remove_session(self, token: str):
+        with self.lock:
+            self.db.execute('DELETE FROM sessions WHERE token = ?', (token,))
+
+    def session(self, token: str) -> Optional[Tuple[str, int]]:
+        '''User and deadline of a session, None if there is none'''
+        with self.lock:
+            return self.db.execute(
+                'SELECT user, deadline FROM sessions WHERE token = ?',
+                (token,)).fetchone()
+
+    def renew_session(self, token: str, deadline: int):
+        with self.lock:
+            self.db.execute('UPDATE sessions SET deadline = ? WHERE token = ?',
+                            (deadline, token))
+
+    def count_sessions(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def append_record(self, seq: int, record: Dict):
+        with self.lock:
+            self.db.execute('INSERT INTO records VALUES (?, ?)',
+                            (seq, json.dumps(record, ensure_ascii=False)))
+
+    def records_since(self, seq: int) -> List[Tuple[int, Dict]]:
+        '''Records committed after seq, in order'''
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT seq, record FROM records WHERE seq > ? ORDER BY seq',
+                (seq,)).fetchall()
+        return [(seq, json.loads(record)) for seq, record in rows]
+
+
+class SharedAuthenticator(Authenticator):
+    '''Authenticator of the state process, keeps the sessions in the store
+
+    Workers check and renew sessions in the store, expiry follows the
+    deadlines found there.
+    '''
+    store: SharedStore
+
+    def __init__(self, file_path: str, store: SharedStore):
+        super().__init__(file_path)
+        self.store = store
+
+    def finish_login(self, user: str, record: Optional[str]) -> str:
+        token = super().finish_login(user, record)
+        self.store.add_session(token, user, self.token_ttl_dict[token])
+        return token
+
+    def finish_register(self, user: str, record: str) -> str:
+        token = super().finish_register(user, record)
+        self.store.add_session(token, user, self.token_ttl_dict[token])
+        return token
+
+    def logout(self, token: str) -> bool:
+        result = super().logout(token)
+        self.store.remove_session(token)
+        return result
+
+    def expire_tokens(self):
+        # only sessions whose deadline came up may have been renewed by a
+        # worker since, read their deadline from the store
+        now = get_time()
+        heap = self.expiry_heap
+        due = []
+        while heap and now > heap[0][0]:
+            due.append(heapq.heappop(heap)[1])
+
+        for token in due:
+            if token not in self.token_ttl_dict:  # already logout
+                continue
+            session = self.store.session(token)
+            if session:
+                self.token_ttl_dict[token] = session[1]
+            heapq.heappush(heap, (self.token_ttl_dict[token], token))
+
+        super().expire_tokens()
+
+
+class Serialized:
+    '''Run every method call of the wrapped object under one lock'''
+
+    def __init__(self, obj, lock: Lock):
+        self._obj = obj
+        self._lock = lock
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return call
+
+
+class SessionView:
+    '''Sessions as seen by a worker
+
+    Checks and renewals read the store, logins, registrations and logouts
+    are forwarded to the state process.
+    '''
+
+    def __init__(self, auth, store: SharedStore):
+        self._auth = auth
+        self._store = store
+
+    def __getattr__(self, name: str):
+        return getattr(self._auth, name)
+
+    def auth(self, token: str, renew: bool = False) -> str:
+        '''user auth, return user if success, renew extends the session'''
+        session = self._store.session(token) if token else None
+        now = get_time()
+        if session is None or now > session[1]:
+            raise AuthenticationError(401, 'Unauthorized')
+
+        user, deadline = session
+        if renew and now + TOKEN_TTL - deadline >= RENEW_SLACK:
+            self._store.renew_session(token, now + TOKEN_TTL)
+        return user
+
+    def renewal_token(self, token):
+        self.auth(token, True)
+
+    def count_online(self) -> int:
+        return self._store.count_sessions()
+
+
+class ForumView:
+    '''Forum as seen by a worker
+
+    Reads are served by a local copy of the forum, which replays the records
+    committed by the state process before each read. Writes are forwarded
+    to the state process.
+    '''
+    READS = ('list_threads', 'read_thread', 'read_thread_since',
+             'prepare_upload', 'download_file')
+
+    def __init__(self, forum, store: SharedStore, data_path: str):
+        self._forum = forum
+        self._store = store
+        records, self._seq = forum.export_records()
+        self._local = ForumHandler(None, data_path)
+        self._local.replay(records)
+
+    def __getattr__(self, name: str):
+        if name not in self.READS:
+            return getattr(self._forum, name)
+
+        for seq, record in self._store.records_since(self._seq):
+            self._local.replay([record])
+            self._seq = seq
+        return getattr(self._local, name)
+
+
+def public_methods(cls) -> list:
+    return [name for name in dir(cls)
+            if not name.startswith('_') and callable(getattr(cls, name))]
+
+
+def init_state(auth_file: str, db_path: str, data_path: str, store_path: str,
+               durability: str, flush_interval: float, flush_ops: int):
+    '''Create the shared Authenticator and ForumHandler in the state process'''
+    lock = Lock()
+    store = SharedStore(store_path)
+    store.reset()
+
+    auth = SharedAuthenticator(auth_file, store)
+    forum = ForumHandler(db_path, data_path,
+                         durability, flush_interval, flush_ops,
+                         on_commit=store.append_record)
+
+    _state['auth'] = Serialized(auth, lock)
+    _state['forum'] = Serialized(forum, lock)
+
+    def check_ttl():
+        while True:
+            _state['auth'].expire_tokens()
+            time.sleep(EXPIRE_INTERVAL)
+
+    Thread(target=check_ttl, daemon=True).start()
+
+
+def get_auth():
+    return _state['auth']
+
+
+def get_forum():
+    return _state['forum']
+
+
+class StateManager(BaseManager):
+    '''Share one Authenticator and ForumHandler between worker processes
+
+    Only logins, registrations, logouts and forum writes reach the state
+    process, workers read sessions and records from the SharedStore.
+    '''
+    ...
+
+
+StateManager.register('auth', get_auth,
+                      exposed=public_methods(Authenticator))
+StateManager.register('forum', get_forum,
+                      exposed=public_methods(ForumHandler))
@@ -0,0 +1,440 @@
+import json
+import sqlite3
+from os import path, replace
+from threading import Condition, Lock, Thread
+from typing import Dict, List, Tuple
+
+from .models import ForumFile, ForumMessage, ForumModelEncoder, ForumThread
+
+JOURNAL_LIMIT = 1000
+
+# Durability policy
+DURABILITY_EVERY_OP = 'every-op'  # write every record at once
+DURABILITY_INTERVAL = 'interval'  # group records and let the flusher write them
+DURABILITY_ON_SHUTDOWN = 'on-shutdown'  # keep records in memory until close()
+
+DURABILITY = (DURABILITY_EVERY_OP, DURABILITY_INTERVAL, DURABILITY_ON_SHUTDOWN)
+
+FLUSH_INTERVAL = 0.05
+FLUSH_OPS = 64
+
+
+class ForumStorage:
+    '''Persistence backend of ForumHandler
+
+    ForumHandler keeps the forum in memory and passes every mutation as a
+    record (see ForumHandler.__apply) to commit(). Records are written
+    according to the durability policy, a backend only implements load()
+    and write().
+    '''
+    durability: str
+    flush_interval: float
+    flush_ops: int
+    pending: List[Dict]
+
+    def __init__(self, durability: str = DURABILITY_EVERY_OP,
+                 flush_interval: float = FLUSH_INTERVAL, flush_ops: int = FLUSH_OPS):
+        if durability not in DURABILITY:
+            raise ValueError(f'Unknown durability policy {durability}')
+
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.pending = []
+        self.io_lock = Lock()
+        self.cond = Condition()
+
+    def start(self):
+        '''Start the background flusher if the policy needs one'''
+        if self.durability == DURABILITY_INTERVAL:
+            Thread(target=self.__flush_loop, daemon=True).start()
+
+    def load(self) -> Tuple[Dict[int, ForumThread], List[Dict]]:
+        '''Return the stored threads and the records to replay on top of them
+
+        Threads may be returned with messages and files set to None, they are
+        filled by load_thread() on first access.
+        '''
+        raise NotImplementedError
+
+    def load_thread(self, thread: ForumThread):
+        '''Fill messages and files of a lazily loaded thread'''
+        ...
+
+    def write(self, records: List[Dict]):
+        '''Persist a group of records'''
+        raise NotImplementedError
+
+    def save(self, pid_dict: Dict[int, ForumThread]):
+        '''Persist the whole forum, pending records are part of it'''
+        with self.io_lock:
+            with self.cond:
+                self.pending = []
+
+    def need_save(self) -> bool:
+        '''True if save() should be called after the current commit'''
+        return False
+
+    def commit(self, record: Dict, pid_dict: Dict[int, ForumThread]):
+        '''Persist one record according to the durability policy'''
+        if self.durability == DURABILITY_EVERY_OP:
+            with self.io_lock:
+                self.write([record])
+
+        else:
+            with self.cond:
+                self.pending.append(record)
+                if self.durability == DURABILITY_INTERVAL and \
+                        (len(self.pending) == 1 or len(self.pending) >= self.flush_ops):
+                    self.cond.notify()
+
+        if self.need_save():
+            self.save(pid_dict)
+
+    def __flush_loop(self):
+        '''Background flusher, coalesce records within flush_interval or flush_ops'''
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+                if len(self.pending) < self.flush_ops:
+                    self.cond.wait(self.flush_interval)
+
+            self.flush()
+
+    def flush(self):
+        '''Write all pending records'''
+        with self.io_lock:
+            with self.cond:
+                records = self.pending
+                self.pending = []
+
+            if records:
+                self.write(records)
+
+    def close(self, pid_dict: Dict[int, ForumThread]):
+        '''Persist everything that is still in memory'''
+        self.flush()
+
+
+class JsonStorage(ForumStorage):
+    '''db.json snapshot plus an append-only journal of records
+
+    Records carry a sequence number and the snapshot stores the last one it
+    contains, so a crash between snapshot and journal truncation does not
+    replay records twice.
+    '''
+    file_path: str
+    journal_path: str
+    journal = None
+    journal_count = 0
+    seq = 0
+
+    def __init__(self, file_path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_path = file_path
+        self.journal_path = f'{file_path}.journal'
+
+    def load(self) -> Tuple[Dict[int, ForumThread], List[Dict]]:
+        pid_dict = {}
+        records = []
+
+        try:
+            if not path.exists(self.file_path):
+                open(self.file_path, 'a', encoding='utf-8').close()
+
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                jd = json.load(f)
+                if not isinstance(jd, dict):
+                    jd = {}
+
+                self.seq = int(jd.pop('_seq', 0))
+
+                for p_id, post in jd.items():
+                    try:
+                        p_id = int(p_id)
+
+                        p_title = post['title']
+                        p_author = post['author']
+                        p_next_mid = max(int(post['next_mid']), 1)
+                        p_next_fid = max(int(post['next_fid']), 1)
+                        p_messages = post['messages']
+                        p_files = post['files']
+
+                        if not isinstance(p_messages, dict):
+                            p_messages = {}
+
+                        if not isinstance(p_files, dict):
+                            p_files = {}
+
+                        messages = {}
+                        for m_id, reply in p_messages.items():
+                            try:
+                                m_id = int(m_id)
+                                if m_id > p_next_mid:
+                                    p_next_mid = m_id + 1
+                                r_author = reply['author']
+                                r_message = reply['message']
+                                messages[m_id] = ForumMessage(
+                                    m_id, r_author, r_message
+                                )
+
+                            except (KeyError, ValueError) as e:
+                                print(e)
+
+                        files = {}
+                        for f_id, file in p_files.items():
+                            try:
+                                f_id = int(f_id)
+                                if f_id > p_next_fid:
+                                    p_next_fid = f_id + 1
+                                f_uploader = file['uploader']
+                                f_name = file['name']
+                                files[f_id] = ForumFile(
+                                    f_id, f_uploader, f_name
+                                )
+
+                            except (KeyError, ValueError) as e:
+                                print(e)
+
+                        pid_dict[p_id] = ForumThread(
+                            p_id, p_title, p_author,
+                            p_next_mid, p_next_fid,
+                            messages, files
+                        )
+
+                    except (KeyError, ValueError) as e:
+                        print(e)
+
+        except Exception as e:
+            print(e)
+
+        if path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    try:
+                        record = json.loads(line)
+                        if record['seq'] <= self.seq:
+                            # already contained in the snapshot
+                            continue
+                        records.append(record)
+                        self.seq = record['seq']
+                    except (KeyError, ValueError) as e:
+                        # a torn tail record after a crash, stop replay here
+                        print(e)
+                        break
+
+        return (pid_dict, records)
+
+    def save(self, pid_dict: Dict[int, ForumThread]):
+        '''Write a full snapshot and truncate the journal'''
+        with self.io_lock:
+            with self.cond:
+                self.pending = []
+
+            try:
+                snapshot = {'_seq': self.seq}
+                for pid in sorted(pid_dict.keys()):
+                    snapshot[str(pid)] = pid_dict[pid]
+
+                tmp_path = f'{self.file_path}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(
+                        snapshot, f,
+                        cls=ForumModelEncoder,
+                        indent=2,
+                    )
+                replace(tmp_path, self.file_path)
+
+                if self.journal:
+                    self.journal.close()
+                self.journal = open(self.journal_path, 'w', encoding='utf-8')
+                self.journal_count = 0
+
+            except Exception as e:
+                print(e)
+
+    def need_save(self) -> bool:
+        return self.journal_count + len(self.pending) >= JOURNAL_LIMIT
+
+    def commit(self, record: Dict, pid_dict: Dict[int, ForumThread]):
+        self.seq += 1
+        record['seq'] = self.seq
+        super().commit(record, pid_dict)
+
+    def write(self, records: List[Dict]):
+        '''Append a group of records with one write'''
+        try:
+            lines = [f'{json.dumps(r, ensure_ascii=False)}\n' for r in records]
+            self.journal.write(''.join(lines))
+            self.journal.flush()
+            self.journal_count += len(lines)
+
+        except Exception as e:
+            print(e)
+
+
+class SqliteStorage(ForumStorage):
+    '''SQLite database in WAL mode, one row level transaction per group of records
+
+    Threads are loaded at startup, their messages and files on first access.
+    Rows reference threads by an internal row id.
+    '''
+    file_path: str
+    db: sqlite3.Connection
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS threads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pid INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            next_mid INTEGER NOT NULL,
+            next_fid INTEGER NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS threads_title ON threads (title);
+        CREATE INDEX IF NOT EXISTS threads_pid ON threads (pid);
+
+        CREATE TABLE IF NOT EXISTS messages (
+            thread_id INTEGER NOT NULL REFERENCES threads (id) ON DELETE CASCADE,
+            mid INTEGER NOT NULL,
+            author TEXT NOT NULL,
+            message TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_thread_mid ON messages (thread_id, mid);
+
+        CREATE TABLE IF NOT EXISTS files (
+            thread_id INTEGER NOT NULL REFERENCES threads (id) ON DELETE CASCADE,
+            fid INTEGER NOT NULL,
+            uploader TEXT NOT NULL,
+            name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_thread_fid ON files (thread_id, fid);
+    '''
+
+    THREAD_ID = '(SELECT id FROM threads WHERE pid = ?)'
+
+    def __init__(self, file_path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_path = file_path
+
+        # used by the main loop and the flusher, always under io_lock
+        self.db = sqlite3.connect(file_path, check_same_thread=False,
+                                  isolation_level=None, cached_statements=256)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(self.SCHEMA)
+
+    def load(self) -> Tuple[Dict[int, ForumThread], List[Dict]]:
+        pid_dict = {}
+
+        with self.io_lock:
+            rows = self.db.execute(
+                'SELECT pid, title, author, next_mid, next_fid FROM threads ORDER BY pid')
+            for pid, title, author, next_mid, next_fid in rows:
+                pid_dict[pid] = ForumThread(
+                    pid, title, author, next_mid, next_fid, None, None)
+
+        return (pid_dict, [])
+
+    def load_thread(self, thread: ForumThread):
+        # Records touching a thread are only created after it is loaded, so
+        # the rows of an unloaded thread are never behind pending records.
+        with self.io_lock:
+            thread_id = '(SELECT id FROM threads WHERE title = ?)'
+
+            rows = self.db.execute(
+                f'SELECT mid, author, message FROM messages WHERE thread_id = {thread_id} ORDER BY mid',
+                (thread.title,))
+            messages = {mid: ForumMessage(mid, author, message)
+                        for mid, author, message in rows}
+
+            rows = self.db.execute(
+                f'SELECT fid, uploader, name FROM files WHERE thread_id = {thread_id} ORDER BY fid',
+                (thread.title,))
+            files = {fid: ForumFile(fid, uploader, name)
+                     for fid, uploader, name in rows}
+
+        thread.load(messages, files)
+
+    def write(self, records: List[Dict]):
+        db = self.db
+        thread_id = self.THREAD_ID
+        try:
+            db.execute('BEGIN')
+            for record in records:
+                op = record['op']
+                pid = record['pid']
+
+                if op == 'CRT':
+                    db.execute(
+                        'INSERT INTO threads (pid, title, author, next_mid, next_fid) VALUES (?, ?, ?, 1, 1)',
+                        (pid, record['title'], record['author']))
+
+                elif op == 'RMV':
+                    db.execute('DELETE FROM threads WHERE pid = ?', (pid,))
+
+                elif op == 'MSG':
+                    db.execute(
+                        f'INSERT INTO messages (thread_id, mid, author, message) VALUES ({thread_id}, ?, ?, ?)',
+                        (pid, record['mid'], record['author'], record['message']))
+                    db.execute(
+                        'UPDATE threads SET next_mid = ? WHERE pid = ?',
+                        (record['mid'] + 1, pid))
+
+                elif op == 'EDT':
+                    db.execute(
+                        f'UPDATE messages SET message = ? WHERE thread_id = {thread_id} AND mid = ?',
+                        (record['message'], pid, record['mid']))
+
+                elif op == 'DLT':
+                    db.execute(
+                        f'DELETE FROM messages WHERE thread_id = {thread_id} AND mid = ?',
+                        (pid, record['mid']))
+
+                elif op == 'UPD':
+                    db.execute(
+                        f'INSERT INTO files (thread_id, fid, uploader, name) VALUES ({thread_id}, ?, ?, ?)',
+                        (pid, record['fid'], record['uploader'], record['name']))
+                    db.execute(
+                        'UPDATE threads SET next_fid = ? WHERE pid = ?',
+                        (record['fid'] + 1, pid))
+
+            db.execute('COMMIT')
+
+        except Exception as e:
+            db.execute('ROLLBACK')
+            print(e)
+
+    def close(self, pid_dict: Dict[int, ForumThread]):
+        super().close(pid_dict)
+        with self.io_lock:
+            self.db.close()
+
+
+class MemoryStorage(ForumStorage):
+    '''Nothing is persisted, for forum copies filled with replayed records'''
+
+    def load(self) -> Tuple[Dict[int, ForumThread], List[Dict]]:
+        return ({}, [])
+
+    def write(self, records: List[Dict]):
+        pass
+
+
+def open_storage(file_path: str, *args, **kwargs) -> ForumStorage:
+    '''Pick the backend from the file extension, .db/.sqlite use SQLite
+
+    None keeps the forum in memory only.
+    '''
+    if file_path is None:
+        return MemoryStorage(*args, **kwargs)
+    if file_path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return SqliteStorage(file_path, *args, **kwargs)
+    return JsonStorage(file_path, *args, **kwargs)
@@ -1,65 +1,436 @@
-
-from queue import Queue
+import os
+import selectors
+from os import path, remove
 from socket import socket as Socket
-from typing import Dict, Tuple
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
 
 from .authenticator import Authenticator
-from .exceptions import (AuthenticationError, ForumBaseException,
+from .exceptions import (AuthenticationError, FileIOError, ForumBaseException,
                          MissingParamsError, PayloadInvlidError,
-                         UnrecognizedCmdError)
+                         ServerBusyError, UnrecognizedCmdError)
 from .forum_handler import ForumHandler
 from .payload_helper import PayloadHelper
-from .utils import json_deserializer, log
+from .utils import CHUNK_SIZE, FRAME_HEAD, json_deserializer, log, pack_frame
+from .worker_pool import WorkerPool
+
+MAX_HEADER = 64 * 1024
+
+# Bytes handed to one sendfile call
+SENDFILE_BYTES = 1024 * 1024
+
+# Upload bytes waiting for the disk before the connection stops reading
+UPLOAD_BUFFER = 4 * 1024 * 1024
+# Pipelined bytes not handled yet, e.g. behind a download, before it stops too
+PIPELINE_BUFFER = 4 * 1024 * 1024
+
+
+def open_upload(part_path: str) -> BinaryIO:
+    '''Create the thread folder if needed and open the partial file'''
+    os.makedirs(path.dirname(part_path), exist_ok=True)
+    return open(part_path, 'wb')
+
+
+def open_download(file_path: str) -> Tuple[BinaryIO, int]:
+    '''Open a file to stream, return it with its size'''
+    f = open(file_path, 'rb')
+    return (f, os.fstat(f.fileno()).st_size)
+
+
+class TCPConnection():
+    '''State of one TCP connection
+
+    A request is a length prefixed JSON header, an UPD header is followed by
+    length prefixed file chunks and a zero length chunk. A successful DWN
+    response header is followed by exactly `size` bytes of raw file content.
+    The connection stays open, requests may be pipelined and are answered
+    in order.
+
+    File I/O runs on the I/O pool, one job per connection at a time. No
+    new request is handled while a job is running, upload chunks keep being
+    buffered in wbuf up to UPLOAD_BUFFER.
+    '''
+    sock: Socket
+    addr: Tuple[str, int]
+    inbuf: bytearray
+    outbuf: bytearray
+
+    # UPD currently receiving chunks
+    header: Dict = None
+    user: str = None
+    upload: BinaryIO = None
+    part_path: str = None
+    response: bytes = None
+    chunk_left = 0
+    # received chunk data not written yet, all chunks received
+    wbuf: bytearray
+    upload_done = False
+
+    # DWN waiting for its file to open, then sending raw content
+    header_download: Dict = None
+    # name of the file as stored, a DWN may ask for it by id
+    download_name: str = None
+    download: BinaryIO = None
+    download_offset = 0
+    download_left = 0
+
+    closing = False
+
+    # an I/O pool job of this connection is running
+    busy = False
+    # released while busy, the files are closed once the job is done
+    released = False
+    # called by the handler once a job is done, to update the events
+    ready: Callable[[], None] = None
+
+    # events registered in the server selector, 0 if unregistered
+    events = selectors.EVENT_READ
+
+    def __init__(self, sock: Socket, addr: Tuple[str, int]):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.wbuf = bytearray()
+
+    def want_read(self) -> bool:
+        return len(self.wbuf) < UPLOAD_BUFFER and len(self.inbuf) < PIPELINE_BUFFER
+
+    def want_write(self) -> bool:
+        return bool(self.outbuf) or self.download is not None
+
+    def reset_upload(self):
+        if self.upload:
+            self.upload.close()
+        if self.part_path and path.exists(self.part_path):
+            remove(self.part_path)
+
+        self.header = None
+        self.user = None
+        self.upload = None
+        self.part_path = None
+        self.response = None
+        self.chunk_left = 0
+        self.wbuf.clear()
+        self.upload_done = False
+
+    def release(self):
+        '''Close the files held by this connection, after its running job'''
+        self.released = True
+        if self.busy:
+            return
+
+        self.reset_upload()
+
+        if self.download:
+            self.download.close()
+            self.download = None
+
+    def close(self):
+        self.release()
+
+        try:
+            self.sock.close()
+        except OSError:
+            pass
 
 
 class TCPHandler():
     auth: Authenticator
     forum: ForumHandler
+    # file I/O, runs inline without a pool
+    pool: Optional[WorkerPool]
 
-    def __init__(self, auth: Authenticator, forum: ForumHandler):
+    def __init__(self, auth: Authenticator, forum: ForumHandler, pool: WorkerPool = None):
         self.auth = auth
         self.forum = forum
+        self.pool = pool
+
+    def __submit(self, conn: TCPConnection, callback: Callable, fn: Callable, *args):
+        '''Run fn on the I/O pool, then callback(result, error) on the loop'''
+        conn.busy = True
+
+        def done(result, error: Optional[BaseException]):
+            conn.busy = False
+            callback(result, error)
+
+            if conn.released:
+                conn.release()
+            elif self.pool:
+                # serve requests received meanwhile
+                if not conn.busy and conn.inbuf:
+                    self.handle_data(conn, b'')
+                if conn.ready:
+                    conn.ready()
+
+        if self.pool is None:
+            try:
+                result = fn(*args)
+            except Exception as e:
+                done(None, e)
+            else:
+                done(result, None)
+
+        elif not self.pool.submit(done, fn, *args):
+            conn.busy = False
+            callback(None, ServerBusyError(
+                503, 'Server busy, please try again later'))
+
+    def handle_data(self, conn: TCPConnection, data: bytes):
+        '''Consume received bytes, queue responses in conn.outbuf'''
+        conn.inbuf += data
+
+        while not conn.closing and conn.download is None:
+            if conn.header is not None:
+                if not self.__recv_chunk(conn):
+                    break
+                continue
+
+            if conn.busy or len(conn.inbuf) < FRAME_HEAD.size:
+                break
+
+            size, = FRAME_HEAD.unpack_from(conn.inbuf)
+            if size > MAX_HEADER:
+                err = PayloadInvlidError(413, 'Payload too large')
+                conn.outbuf += pack_frame(
+                    PayloadHelper.response_error(err, 'FAULT'))
+                conn.closing = True
+                break
+
+            end = FRAME_HEAD.size + size
+            if len(conn.inbuf) < end:
+                break
+
+            raw = bytes(conn.inbuf[FRAME_HEAD.size:end])
+            del conn.inbuf[:end]
+
+            response = self.handle_message(conn, raw)
+            if response:
+                conn.outbuf += pack_frame(response)
+
+    def handle_write(self, conn: TCPConnection):
+        '''Send queued bytes, then the file being downloaded'''
+        if conn.outbuf:
+            sent = conn.sock.send(conn.outbuf)
+            del conn.outbuf[:sent]
+
+        elif conn.download:
+            count = min(conn.download_left, SENDFILE_BYTES)
+            if count:
+                sent = self.__send_file(conn, count)
+                if not sent:
+                    raise ConnectionError('File truncated while sending')
+                conn.download_offset += sent
+                conn.download_left -= sent
+
+            if not conn.download_left:
+                self.finish_download(conn)
+
+    def finish_download(self, conn: TCPConnection):
+        '''Close the downloaded file and serve requests received meanwhile'''
+        conn.download.close()
+        conn.download = None
+
+        if conn.inbuf:
+            self.handle_data(conn, b'')
 
-    def handle_message(self, raw: bytes, addr: Tuple[str, int]):
+    @staticmethod
+    def __send_file(conn: TCPConnection, count: int) -> int:
+        '''Copy file content to the socket without passing it through Python'''
+        if hasattr(os, 'sendfile'):
+            return os.sendfile(conn.sock.fileno(), conn.download.fileno(),
+                               conn.download_offset, count)
+
+        conn.download.seek(conn.download_offset)
+        data = conn.download.read(min(count, CHUNK_SIZE))
+        return conn.sock.send(data)
+
+    def __recv_chunk(self, conn: TCPConnection) -> bool:
+        '''Queue upload chunk data for the disk, return False if more bytes are needed'''
+        if conn.upload_done:
+            # the next request waits for the upload to finish
+            return False
+
+        if conn.chunk_left == 0:
+            if len(conn.inbuf) < FRAME_HEAD.size:
+                return False
+
+            size, = FRAME_HEAD.unpack_from(conn.inbuf)
+            del conn.inbuf[:FRAME_HEAD.size]
+
+            if size == 0:
+                conn.upload_done = True
+                self.__flush_upload(conn)
+                return True
+
+            conn.chunk_left = size
+
+        data = conn.inbuf[:conn.chunk_left]
+        if not data:
+            return False
+
+        del conn.inbuf[:len(data)]
+        conn.chunk_left -= len(data)
+
+        # chunks of a failed upload are dropped
+        if conn.response is None:
+            conn.wbuf += data
+            self.__flush_upload(conn)
+
+        return True
+
+    def __upload_error(self, conn: TCPConnection, error: Optional[BaseException]):
+        '''Answer the upload with an error, drop the file and pending data'''
+        if not isinstance(error, ForumBaseException):
+            name = conn.header['name']
+            error = FileIOError(500, f'Can not write file {name}')
+        conn.response = PayloadHelper.response_error(
+            error, conn.header['echo'])
+
+        if conn.upload:
+            conn.upload.close()
+            conn.upload = None
+        conn.wbuf.clear()
+
+    def __flush_upload(self, conn: TCPConnection):
+        '''Start the next disk job of an upload: open, write, close'''
+        if conn.busy:
+            return
+
+        if conn.upload is None and conn.part_path and conn.response is None:
+            self.__submit(conn, lambda f, e: self.__upload_opened(conn, f, e),
+                          open_upload, conn.part_path)
+
+        elif conn.upload and conn.wbuf:
+            data = bytes(conn.wbuf)
+            conn.wbuf.clear()
+            self.__submit(conn, lambda _, e: self.__upload_written(conn, e),
+                          conn.upload.write, data)
+
+        elif conn.upload and conn.upload_done:
+            self.__submit(conn, lambda _, e: self.__upload_closed(conn, e),
+                          conn.upload.close)
+
+        elif conn.upload_done:
+            self.__finish_upload(conn)
+
+    def __upload_opened(self, conn: TCPConnection, f: Optional[BinaryIO], error: Optional[BaseException]):
+        if error:
+            self.__upload_error(conn, error)
+        else:
+            conn.upload = f
+        if not conn.released:
+            self.__flush_upload(conn)
+
+    def __upload_written(self, conn: TCPConnection, error: Optional[BaseException]):
+        if error:
+            self.__upload_error(conn, error)
+        if not conn.released:
+            self.__flush_upload(conn)
+
+    def __upload_closed(self, conn: TCPConnection, error: Optional[BaseException]):
+        conn.upload = None
+        if error:
+            self.__upload_error(conn, error)
+        if not conn.released:
+            self.__finish_upload(conn)
+
+    def __finish_upload(self, conn: TCPConnection):
+        payload = conn.header
+        response = conn.response
+
+        if response is None:
+            echo = payload['echo']
+            try:
+                cmd = payload['cmd']
+                title = payload['title']
+                name = payload['name']
+                user = conn.user
+
+                result = self.forum.upload_file(
+                    title, name, conn.part_path, user)
+                conn.part_path = None
+
+                response = PayloadHelper.response_file(
+                    200, result, '', 0, echo)
+
+                log(f'{user} issued {cmd} command', conn.addr, False)
+                log(f'{user} uploaded file {name} to {title} thread',
+                    conn.addr, False)
+
+            except ForumBaseException as e:
+                response = PayloadHelper.response_error(e, echo)
+
+            except Exception as e:
+                err = ForumBaseException(500, 'Internal Server Error')
+                response = PayloadHelper.response_error(err, echo)
+
+        conn.reset_upload()
+        conn.outbuf += pack_frame(response)
+
+    def __download_opened(self, conn: TCPConnection, opened: Optional[Tuple[BinaryIO, int]], error: Optional[BaseException]):
+        '''Answer a DWN once the file is open, the content follows the header'''
+        payload = conn.header_download
+        conn.header_download = None
+        echo = payload['echo']
+        name = conn.download_name
+
+        if error:
+            if not isinstance(error, ForumBaseException):
+                error = FileIOError(404, f'Can not read file {name}')
+            conn.outbuf += pack_frame(PayloadHelper.response_error(error, echo))
+            return
+
+        conn.download, size = opened
+        conn.download_offset = 0
+        conn.download_left = size
+
+        result = f'Successfully download file {name}'
+        conn.outbuf += pack_frame(
+            PayloadHelper.response_file(200, result, name, size, echo))
+
+        user = conn.user
+        log(f'{user} issued DWN command', conn.addr, False)
+        log(f'{user} downloaded file {name} from {payload["title"]} thread',
+            conn.addr, False)
+
+    def handle_message(self, conn: TCPConnection, raw: bytes):
+        addr = conn.addr
+        echo = 'FAULT'
         try:
             response = None
-            # addr = sock.getpeername()
             payload = json_deserializer(raw)
 
             # log(f'T IN  <-- {payload}', None, False)
 
             echo = payload['echo']
 
+            if payload.get('cmd', None) == 'UPD':
+                # the file chunks follow the header whatever happens
+                conn.header = payload
+
             if 'cmd' in payload and 'title' in payload and 'name' in payload and 'token' in payload:
                 cmd = payload['cmd']
                 title = payload['title']
                 token = payload['token']
                 name = payload['name']
-                user = self.auth.auth(token)
+                user = self.auth.auth(token, True)
 
                 if cmd == 'UPD':
-                    if 'body' not in payload:
-                        raise MissingParamsError(
-                            400, 'Missing body in the payload')
-                    body = payload['body']
-                    result = self.forum.upload_file(title, name, body, user)
-
-                    response = PayloadHelper.response_file(
-                        200, result, '', '', echo)
-                    
-                    log(f'{user} issued {cmd} command', addr, False)
-                    log(f'{user} uploaded file {name} to {title} thread', addr, False)
+                    # the partial file is opened on the I/O pool
+                    conn.part_path = self.forum.prepare_upload(title, name)
+                    conn.user = user
+                    self.__flush_upload(conn)
 
                 elif cmd == 'DWN':
-                    body = self.forum.download_file(title, name)
-                    result = f'Successfully download file {name}'
-
-                    response = PayloadHelper.response_file(
-                        200, result, name, body, echo)
-                    
-                    log(f'{user} issued {cmd} command', addr, False)
-                    log(f'{user} downloaded file {name} from {title} thread', addr, False)
-                    
+                    # answered once the file is opened on the I/O pool
+                    file_path, conn.download_name = self.forum.download_file(
+                        title, name)
+                    conn.user = user
+                    conn.header_download = payload
+                    self.__submit(conn, lambda r, e: self.__download_opened(conn, r, e),
+                                  open_download, file_path)
+                    return None
+
                 else:
                     raise UnrecognizedCmdError(400, f'Unrecognized cmd {cmd}')
 
@@ -67,6 +438,8 @@ class TCPHandler():
                 raise MissingParamsError(400, 'Bad Request')
 
         except PayloadInvlidError as e:
+            # can not tell whether file chunks follow, give up the connection
+            conn.closing = True
             response = PayloadHelper.response_error(e, 'FAULT')
 
         except AuthenticationError as e:
@@ -85,13 +458,18 @@ class TCPHandler():
             err = ForumBaseException(500, 'Internal Server Error')
             response = PayloadHelper.response_error(err, echo)
 
-        finally:
-            if not response:
-                err = ForumBaseException(500, 'Internal Server Error')
-                response = PayloadHelper.response_error(err, echo)
+        if conn.header is not None and not conn.closing:
+            # UPD answers once all chunks are received and written
+            if response:
+                conn.response = response
+            return None
+
+        if not response:
+            err = ForumBaseException(500, 'Internal Server Error')
+            response = PayloadHelper.response_error(err, echo)
 
-            # log(f'T OUT --> {response.decode("utf-8")}', addr, False)
-            return response
+        # log(f'T OUT --> {response.decode("utf-8")}', addr, False)
+        return response
 
     @staticmethod
     def close_socket(sock: Socket):
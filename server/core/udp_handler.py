@@ -1,16 +1,20 @@
 
+import time
+from collections import OrderedDict
 from socket import socket as Socket
-from threading import Thread
-from typing import Tuple
+from typing import List, Optional, Set, Tuple
 
 from .authenticator import Authenticator
+from .authenticator import hash_password, verify_password
 from .exceptions import (ArgumentError, AuthenticationError,
                          ForumBaseException, MissingParamsError,
-                         PayloadInvlidError, UnrecognizedCmdError,
-                         UnsupportedMethod)
+                         PayloadInvlidError, ServerBusyError,
+                         UnrecognizedCmdError, UnsupportedMethod)
 from .forum_handler import ForumHandler
 from .payload_helper import PayloadHelper
-from .utils import json_deserializer, log
+from .utils import COMPRESS_ZLIB, MAX_DATAGRAM, log
+from .wire import PROTO_BINARY, deserialize, heartbeat_token, is_binary
+from .worker_pool import WorkerPool
 
 CMD_USAGE = {
     'CRT': 'Usage: CRT threadtitle',
@@ -31,211 +35,465 @@ CMD_USAGE = {
 
 CMDS = CMD_USAGE.keys()
 
+# Largest page of LST and RDT
+MAX_PAGE_SIZE = 100
+
+# Commands in one BATCH request
+BATCH_MAX = 64
+
+# Responses kept to answer retransmitted requests and to resend fragments
+RESPONSE_CACHE = 1024
+RESPONSE_TTL = 30
+# Total bytes of cached datagrams
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
 
 class UDPHandler():
     sock: Socket
     auth: Authenticator
     forum: ForumHandler
-
-    def __init__(self, auth: Authenticator, forum: ForumHandler, sock: Socket):
+    # (addr, echo) -> (expire time, datagrams of the response)
+    responses: 'OrderedDict[Tuple[Tuple[str, int], str], Tuple[float, List[bytes]]]'
+    responses_size: int
+    # password hashing, runs inline without a pool
+    pool: Optional[WorkerPool]
+    # (addr, echo) of logins and registrations waiting for the pool
+    verifying: Set[Tuple[Tuple[str, int], str]]
+
+    def __init__(self, auth: Authenticator, forum: ForumHandler, sock: Socket, pool: WorkerPool = None):
         self.sock = sock
         self.auth = auth
         self.forum = forum
+        self.pool = pool
+        self.responses = OrderedDict()
+        self.responses_size = 0
+        self.verifying = set()
+
+    def __send(self, response: bytes, addr: Tuple[str, int], echo: str, binary: bool):
+        '''Send a response, fragment it if it does not fit in one datagram'''
+        if len(response) <= MAX_DATAGRAM:
+            datagrams = [response]
+        else:
+            datagrams = PayloadHelper.response_fragments(
+                response, echo, binary)
+
+        self.__cache((addr, echo), datagrams)
+
+        for datagram in datagrams:
+            self.sock.sendto(datagram, addr)
+
+    def __cache(self, key: Tuple[Tuple[str, int], str], datagrams: List[bytes]):
+        '''Keep a response, evict expired and oldest ones beyond the bounds'''
+        # popped first, so a key stored again becomes the newest one
+        old = self.responses.pop(key, None)
+        if old is not None:
+            self.responses_size -= sum(len(d) for d in old[1])
+
+        size = sum(len(d) for d in datagrams)
+        if size > RESPONSE_CACHE_BYTES:
+            return
+
+        now = time.time()
+        while self.responses:
+            first, (expire, cached) = next(iter(self.responses.items()))
+            if expire > now and len(self.responses) < RESPONSE_CACHE and \
+                    self.responses_size + size <= RESPONSE_CACHE_BYTES:
+                break
+            self.responses.pop(first)
+            self.responses_size -= sum(len(d) for d in cached)
+
+        self.responses[key] = (now + RESPONSE_TTL, datagrams)
+        self.responses_size += size
+
+    def __replay(self, addr: Tuple[str, int], echo: str) -> bool:
+        '''Answer a retransmitted request from the cache, False if not cached'''
+        expire, datagrams = self.responses.get((addr, echo), (0, []))
+        if expire < time.time():
+            return False
+
+        for datagram in datagrams:
+            self.sock.sendto(datagram, addr)
+        return True
+
+    def __resend(self, missing: List[int], addr: Tuple[str, int], echo: str):
+        '''Send fragments again, the response may have expired already'''
+        _, datagrams = self.responses.get((addr, echo), (0, []))
+        if len(datagrams) < 2:
+            return
+        for i in missing:
+            if isinstance(i, int) and 0 <= i < len(datagrams):
+                self.sock.sendto(datagrams[i], addr)
+
+    @staticmethod
+    def __page(payload: dict) -> Tuple[int, int]:
+        '''Cursor and page size of a LST or RDT request, page size 0 for all'''
+        try:
+            cursor = int(payload.get('cursor') or 0)
+            limit = int(payload.get('limit') or 0)
+        except (TypeError, ValueError):
+            raise ArgumentError(400, 'Cursor and limit must be integer!')
 
-        Thread(target=auth.check_ttl, daemon=True).start()
+        if cursor < 0 or limit < 0:
+            raise ArgumentError(400, 'Cursor and limit must not be negative!')
 
-    def handle_message(self, raw: bytes, addr: Tuple[str, int]):
-        try:
-            response = None
+        return (cursor, min(limit, MAX_PAGE_SIZE))
 
-            payload = json_deserializer(raw)
+    def __command(self, cmd: str, payload: dict, token: str, user: str, addr: Tuple[str, int], binary: bool) -> Optional[bytes]:
+        '''Run a command of an authenticated user, return the response'''
+        echo = payload['echo']
+        args = (payload['args'] or '').split()
+        # the client accepts compressed data
+        compress = bool(payload.get('z', None))
 
-            # log(f'U IN  <-- {payload}', None, False)
+        msg = 'OK'
 
-            echo = payload['echo']
+        if cmd == 'HEART':  # Heartbeat, the token was renewed by auth()
+            response = None
 
-            if 'cmd' in payload:
+        elif cmd == 'CRT':  # Create Thread, CRT <title>
+            if len(args) < 1:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            title = ' '.join(args)
+            result = self.forum.create_thread(title, user)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, compress=compress, binary=binary)
+
+        elif cmd == 'LST':  # List Threads, LST
+            if len(args) != 0:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            cursor, limit = self.__page(payload)
+            result, cursor = self.forum.list_threads(cursor, limit)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, cursor=cursor, compress=compress, binary=binary)
+        elif cmd == 'MSG':  # Post Message, MSG <title> <message>
+            if len(args) < 2:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            title = args[0]
+            message = ' '.join(args[1:])
+            result = self.forum.post_message(title, message, user)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, compress=compress, binary=binary)
+        elif cmd == 'EDT':  # Edit Message, EDT <title> <messagenumber> <message>
+            if len(args) < 3:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            title = args[0]
+            message = ' '.join(args[2:])
+            try:
+                messagenum = int(args[1])
+            except ValueError:
+                raise ArgumentError(
+                    400, f'Messagenumber must be integer!')
+
+            result = self.forum.edit_message(
+                title, messagenum, message, user)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, compress=compress, binary=binary)
+        elif cmd == 'DLT':  # Delete Message, DLT <title> <messagenumber>
+            if len(args) < 2:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            title = args[0]
+            try:
+                messagenum = int(args[1])
+            except ValueError:
+                raise ArgumentError(
+                    400, f'Messagenumber must be integer!')
+
+            result = self.forum.delete_message(
+                title, messagenum,  user)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, compress=compress, binary=binary)
+        elif cmd == 'RDT':  # Read Thread, RDT <title>
+            if len(args) < 1:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            title = ' '.join(args)
+
+            if payload.get('since'):
+                cursor = None
+                result, version = self.forum.read_thread_since(
+                    title, str(payload['since']))
+            else:
+                cursor, limit = self.__page(payload)
+                result, cursor, version = self.forum.read_thread(
+                    title, cursor, limit)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, cursor=cursor, version=version, compress=compress, binary=binary)
+        elif cmd == 'UPD':  # Upload file, UPD <title> <filename>
+            err = UnsupportedMethod(
+                400, 'UDP command must send using TCP')
+
+            response = PayloadHelper.response_error(err, echo=echo, binary=binary)
+        elif cmd == 'DWN':  # Download file, DWN <title> <filename>
+            err = UnsupportedMethod(
+                400, 'UDP command must send using TCP')
+
+            response = PayloadHelper.response_error(err, echo=echo, binary=binary)
+        elif cmd == 'RMV':  # Remove Thread, RMV <title>
+            if len(args) < 1:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+
+            title = ' '.join(args)
+
+            result = self.forum.delete_thread(title, user)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, compress=compress, binary=binary)
+
+        elif cmd == 'HLP':  # Help, HLP [command]
+            lines = []
+
+            if args:
+                for arg in args:
+                    if arg in CMDS:
+                        lines.append(CMD_USAGE[arg])
+
+            if not lines:
+                lines.append('Avilable commands:')
+                lines.append(', '.join(CMDS))
+
+            result = '\n'.join(lines)
+
+            response = PayloadHelper.response_command(
+                200, result, msg, echo=echo, compress=compress, binary=binary)
+
+        elif cmd == 'XIT':  # Exit
+            if len(args) != 0:
+                raise ArgumentError(400, CMD_USAGE[cmd])
+            
+            self.auth.logout(token)
+            log(f'User {user} successful logout!', addr, False)
+
+            count = self.auth.count_online()
+            log(f'Online users: {count}', None, False)
+
+            result = f'Bye {user} !'
+
+            response = PayloadHelper.response_command(
+                201, result, msg, echo=echo, compress=compress, binary=binary)
+
+        else:
+            raise UnrecognizedCmdError(
+                400, f'Unrecognized cmd {cmd}')
+
+        if cmd != 'HEART':
+            log(f'{user} issued {cmd} command', addr, False)
+            if result.find('\n')==-1:
+                log(result, addr, False)
+
+        return response
+
+    def __batch(self, payload: dict, token: str, user: str, addr: Tuple[str, int], binary: bool) -> bytes:
+        '''Run the commands of a batch in order, return one combined response'''
+        commands = payload['batch']
+        if not isinstance(commands, list) or len(commands) > BATCH_MAX:
+            raise ArgumentError(
+                400, f'A batch holds at most {BATCH_MAX} commands!')
+
+        responses = []
+        for raw in commands:
+            # binary responses need an integer echo
+            sub_echo = 0 if binary else 'FAULT'
+            cmd = None
+            try:
+                # sub-commands are in the encoding of the batch
+                if isinstance(raw, str) and not binary:
+                    raw = raw.encode('utf-8')
+                elif not isinstance(raw, bytes) or not is_binary(raw):
+                    raise PayloadInvlidError(422, 'Payload invalid')
+                sub = deserialize(raw)
+                sub_echo = sub['echo']
+
+                cmd = sub['cmd']
+                if cmd == 'BATCH' or 'args' not in sub:
+                    raise MissingParamsError(400, 'Bad Request')
 
-                cmd = payload['cmd']
+                response = self.__command(cmd, sub, token, user, addr, binary)
 
-                if 'token' in payload and 'args' in payload:
-                    # normal command
-                    token = payload['token']
-                    user = self.auth.auth(token)
+            except KeyError as e:
+                err = MissingParamsError(400, f'Missing {e} in the payload')
+                response = PayloadHelper.response_error(err, sub_echo, binary)
 
-                    args = (payload['args'] or '').split()
-
-                    msg = 'OK'
+            except ForumBaseException as e:
+                response = PayloadHelper.response_error(e, sub_echo, binary)
 
-                    if cmd == 'HEART':  # Heartbeat
-                        self.auth.renewal_token(token)
-                        response = None
+            except Exception as e:
+                err = ForumBaseException(500, 'Internal Server Error')
+                response = PayloadHelper.response_error(err, sub_echo, binary)
 
-                    elif cmd == 'CRT':  # Create Thread, CRT <title>
-                        if len(args) < 1:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
+            if response:
+                responses.append(response)
 
-                        title = ' '.join(args)
-                        result = self.forum.create_thread(title, user)
+            # the session is gone after XIT
+            if cmd == 'XIT':
+                break
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
+        return PayloadHelper.response_batch(responses, payload['echo'], binary)
 
-                    elif cmd == 'LST':  # List Threads, LST
-                        if len(args) != 0:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
-                        
-                        result = self.forum.list_threads()
+    def __authenticate(self, cmd: str, payload: dict, addr: Tuple[str, int], binary: bool):
+        '''Login or register, the response is sent once the pool hashed the password'''
+        echo = payload['echo']
+        user = payload['user']
+        passwd = payload['passwd']
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
-                    elif cmd == 'MSG':  # Post Message, MSG <title> <message>
-                        if len(args) < 2:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
+        if cmd == 'REG':
+            self.auth.check_register(user, passwd)
+            fn, args = hash_password, (passwd,)
 
-                        title = args[0]
-                        message = ' '.join(args[1:])
-                        result = self.forum.post_message(title, message, user)
+        elif cmd == 'LOG':
+            stored = self.auth.check_login(user, passwd)
+            fn, args = verify_password, (passwd, stored)
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
-                    elif cmd == 'EDT':  # Edit Message, EDT <title> <messagenumber> <message>
-                        if len(args) < 3:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
+        else:
+            raise UnrecognizedCmdError(400, f'Unrecognized cmd {cmd}')
 
-                        title = args[0]
-                        message = ' '.join(args[2:])
-                        try:
-                            messagenum = int(args[1])
-                        except ValueError:
-                            raise ArgumentError(
-                                400, f'Messagenumber must be integer!')
+        key = (addr, echo)
+        if key in self.verifying:
+            # a retransmit, the first copy is still being verified
+            return
 
-                        result = self.forum.edit_message(
-                            title, messagenum, message, user)
+        def done(record: Optional[str], error: Optional[BaseException]):
+            self.verifying.discard(key)
+            self.__authenticated(cmd, user, record, error, addr, echo, binary)
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
-                    elif cmd == 'DLT':  # Delete Message, DLT <title> <messagenumber>
-                        if len(args) < 2:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
+        if self.pool is None:
+            done(fn(*args), None)
 
-                        title = args[0]
-                        try:
-                            messagenum = int(args[1])
-                        except ValueError:
-                            raise ArgumentError(
-                                400, f'Messagenumber must be integer!')
+        elif self.pool.submit(done, fn, *args):
+            self.verifying.add(key)
 
-                        result = self.forum.delete_message(
-                            title, messagenum,  user)
+        else:
+            raise ServerBusyError(503, 'Server busy, please try again later')
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
-                    elif cmd == 'RDT':  # Read Thread, RDT <title>
-                        if len(args) < 1:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
+    def __authenticated(self, cmd: str, user: str, record: Optional[str], error: Optional[BaseException],
+                        addr: Tuple[str, int], echo: str, binary: bool):
+        '''Finish a login or registration and send the response'''
+        try:
+            if error:
+                raise error
 
-                        title = ' '.join(args)
+            if cmd == 'REG':
+                token = self.auth.finish_register(user, record)
+                msg = f'Welcome new user {user} !'
+                log(f'User {user} successful register!', addr, False)
 
-                        result = self.forum.read_thread(title)
+            else:
+                token = self.auth.finish_login(user, record)
+                msg = f'Welcome user {user} !'
+                log(f'User {user} successful login!', addr, False)
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
-                    elif cmd == 'UPD':  # Upload file, UPD <title> <filename>
-                        err = UnsupportedMethod(
-                            400, 'UDP command must send using TCP')
+            count = self.auth.count_online()
+            log(f'Online users: {count}', None, False)
 
-                        response = PayloadHelper.response_error(err, echo=echo)
-                    elif cmd == 'DWN':  # Download file, DWN <title> <filename>
-                        err = UnsupportedMethod(
-                            400, 'UDP command must send using TCP')
+            response = PayloadHelper.response_auth(
+                200, token, msg, echo=echo, binary=binary
+            )
 
-                        response = PayloadHelper.response_error(err, echo=echo)
-                    elif cmd == 'RMV':  # Remove Thread, RMV <title>
-                        if len(args) < 1:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
+        except AuthenticationError as e:
+            err = e.code != 200
+            log(e.msg, addr, err)
+            response = PayloadHelper.response_error(e, echo, binary)
 
-                        title = ' '.join(args)
+        except ForumBaseException as e:
+            response = PayloadHelper.response_error(e, echo, binary)
 
-                        result = self.forum.delete_thread(title, user)
+        except Exception as e:
+            err = ForumBaseException(500, 'Internal Server Error')
+            response = PayloadHelper.response_error(err, echo, binary)
 
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
+        self.__send(response, addr, echo, binary)
 
-                    elif cmd == 'HLP':  # Help, HLP [command]
-                        lines = []
+    def __heartbeat(self, token: str, addr: Tuple[str, int]):
+        '''Renew the session of a compact heartbeat, answer only on failure'''
+        try:
+            self.auth.renewal_token(token)
 
-                        if args:
-                            for arg in args:
-                                if arg in CMDS:
-                                    lines.append(CMD_USAGE[arg])
+        except AuthenticationError as e:
+            log(e.msg, addr, True)
+            response = PayloadHelper.response_error(e, 0, True)
+            self.sock.sendto(response, addr)
 
-                        if not lines:
-                            lines.append('Avilable commands:')
-                            lines.append(', '.join(CMDS))
+    def handle_message(self, raw: bytes, addr: Tuple[str, int]):
+        # compact heartbeats skip the decoding and dispatch below
+        token = heartbeat_token(raw)
+        if token is not None:
+            self.__heartbeat(token, addr)
+            return
+
+        echo = 'FAULT'
+        # answer in the encoding of the request
+        binary = is_binary(raw)
+        try:
+            response = None
 
-                        result = '\n'.join(lines)
-
-                        response = PayloadHelper.response_command(
-                            200, result, msg, echo=echo)
-
-                    elif cmd == 'XIT':  # Exit
-                        if len(args) != 0:
-                            raise ArgumentError(400, CMD_USAGE[cmd])
-                        
-                        self.auth.logout(payload['token'])
-                        log(f'User {user} successful logout!', addr, False)
+            payload = deserialize(raw)
 
-                        count = self.auth.count_online()
-                        log(f'Online users: {count}', None, False)
+            # log(f'U IN  <-- {payload}', None, False)
 
-                        result = f'Bye {user} !'
+            echo = payload['echo']
 
-                        response = PayloadHelper.response_command(
-                            201, result, msg, echo=echo)
+            if 'cmd' in payload:
 
-                    else:
-                        raise UnrecognizedCmdError(
-                            400, f'Unrecognized cmd {cmd}')
+                # a retransmit of a handled request, answer it again without
+                # running the command twice
+                if self.__replay(addr, echo):
+                    return
 
-                    if cmd != 'HEART':
-                        log(f'{user} issued {cmd} command', addr, False)
-                        if result.find('\n')==-1:
-                            log(result, addr, False)
+                cmd = payload['cmd']
 
-                elif 'user' in payload and 'passwd' in payload:
-                    # login/register
-                    user = payload['user']
-                    passwd = payload['passwd']
+                if 'token' in payload and 'args' in payload:
+                    # normal command
+                    token = payload['token']
+                    user = self.auth.auth(token, True)
 
-                    if cmd == 'REG':
-                        token = self.auth.register(user, passwd)
-                        msg = f'Welcome new user {user} !'
-                        log(f'User {user} successful register!', addr, False)
+                    response = self.__command(
+                        cmd, payload, token, user, addr, binary)
 
-                    elif cmd == 'LOG':
-                        token = self.auth.login(user, passwd)
-                        msg = f'Welcome user {user} !'
-                        log(f'User {user} successful login!', addr, False)
+                elif cmd == 'BATCH' and 'token' in payload:
+                    # several commands with a single authentication
+                    token = payload['token']
+                    user = self.auth.auth(token, True)
 
-                    count = self.auth.count_online()
-                    log(f'Online users: {count}', None, False)
+                    response = self.__batch(payload, token, user, addr, binary)
 
-                    response = PayloadHelper.response_auth(
-                        200, token, msg, echo=echo
-                    )
+                elif 'user' in payload and 'passwd' in payload:
+                    # login/register
+                    self.__authenticate(cmd, payload, addr, binary)
 
                 else:
                     raise MissingParamsError(400, 'Bad Request')
 
+            elif 'resend' in payload:
+                # selective retransmit of a fragmented response
+                missing = payload['resend']
+                if isinstance(missing, list):
+                    self.__resend(missing, addr, echo)
+
             elif 'meta' in payload:
                 # meta
                 reply = payload.get('reply', False)
 
                 if reply:
                     log('New client connected', addr, False)
-                    response = PayloadHelper.request_meta(echo, False)
+                    # accept the binary format and compression if offered
+                    proto = payload.get('proto', None)
+                    if proto != PROTO_BINARY:
+                        proto = None
+                    compress = payload.get('compress', None)
+                    if compress != COMPRESS_ZLIB:
+                        compress = None
+                    response = PayloadHelper.request_meta(
+                        echo, False, proto, compress, binary=binary)
                 else:
                     response = None
 
@@ -248,20 +506,20 @@ class UDPHandler():
         except AuthenticationError as e:
             err = e.code != 200
             log(e.msg, addr, err)
-            response = PayloadHelper.response_error(e, echo)
+            response = PayloadHelper.response_error(e, echo, binary)
 
         except KeyError as e:
             err = MissingParamsError(400, f'Missing {e} in the payload')
-            response = PayloadHelper.response_error(err, echo)
+            response = PayloadHelper.response_error(err, echo, binary)
 
         except ForumBaseException as e:
-            response = PayloadHelper.response_error(e, echo)
+            response = PayloadHelper.response_error(e, echo, binary)
 
         except Exception as e:
             err = ForumBaseException(500, 'Internal Server Error')
-            response = PayloadHelper.response_error(err, echo)
+            response = PayloadHelper.response_error(err, echo, binary)
 
         finally:
             if response:
                 # log(f'U OUT --> {response.decode("utf-8")}', None, False)
-                self.sock.sendto(response, addr)
+                self.__send(response, addr, echo, binary)
@@ -1,14 +1,29 @@
 
 import json
-from base64 import b64encode
+import struct
 from json import JSONDecodeError
 from os import path, walk, remove, rmdir
 from time import time
 from typing import Dict, Tuple
 from uuid import uuid1
 
-from .exceptions import (
-    FileTooLargeError, ForumBaseException, PayloadInvlidError)
+from .exceptions import ForumBaseException, PayloadInvlidError
+
+CHUNK_SIZE = 64 * 1024
+
+# Every frame on TCP is prefixed with its length, a zero length chunk ends a file
+FRAME_HEAD = struct.Struct('!I')
+
+# UDP responses larger than MAX_DATAGRAM are split into FRAGMENT_BYTES pieces,
+# which stay below a 1500 bytes MTU once base64 encoded
+MAX_DATAGRAM = 1400
+FRAGMENT_BYTES = 960
+
+# Compress response data of at least COMPRESS_THRESHOLD bytes once negotiated,
+# smaller responses are not worth the CPU time
+COMPRESS_ZLIB = 'zlib'
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
 
 
 def random_str():
@@ -19,16 +34,9 @@ def get_time():
     return int(time())
 
 
-def package_file(file_path: str) -> Tuple[str, str]:
-    name = path.basename(file_path)
-
-    with open(file_path, 'rb') as f:
-        data = f.read()
-        if len(data) > 8000:
-            raise FileTooLargeError(413, 'File too large')
-
-    body = b64encode(data).decode('utf-8')
-    return (name, body)
+def pack_frame(data: bytes) -> bytes:
+    '''Prefix data with its length'''
+    return FRAME_HEAD.pack(len(data)) + data
 
 
 def log(msg: str, addr: Tuple[str, int] = None, error: bool = False):
@@ -0,0 +1,258 @@
+import struct
+from typing import Dict, Optional
+
+from .exceptions import PayloadInvlidError
+from .utils import json_deserializer
+
+# Compact binary encoding of UDP payloads, used once both sides agreed on it
+# in the meta handshake. JSON payloads always start with '{', binary ones
+# with MAGIC, so a server answers every packet in the encoding it came in.
+PROTO_JSON = 'json'
+PROTO_BINARY = 'bin'
+
+MAGIC = 0xB7
+MAGIC_BYTE = bytes((MAGIC,))
+
+# magic, opcode, echo
+HEAD = struct.Struct('!BBI')
+
+# tokens are 32 hex digits, sent as their raw bytes
+TOKEN_BYTES = 16
+TOKEN_FORMAT = f'{TOKEN_BYTES}s'
+
+# length of an integer or packet list
+COUNT = struct.Struct('!H')
+
+# length of a packet in a packet list
+SIZE = struct.Struct('!I')
+
+CMD_OPCODES = {'CRT': 1, 'LST': 2, 'MSG': 3, 'EDT': 4, 'DLT': 5, 'RDT': 6,
+               'UPD': 7, 'DWN': 8, 'RMV': 9, 'XIT': 10, 'HLP': 11, 'HEART': 12}
+CMD_NAMES = {op: cmd for cmd, op in CMD_OPCODES.items()}
+
+OP_UNKNOWN = 0
+OP_LOG = 16
+OP_REG = 17
+OP_BATCH = 18
+OP_META = 20
+OP_RESEND = 21
+OP_HEARTBEAT = 22
+OP_RESPONSE = 32
+OP_AUTH = 33
+OP_ERROR = 34
+OP_FRAG = 35
+OP_RESPONSE_Z = 36  # response with zlib compressed data
+OP_BATCH_RESPONSE = 37
+
+# magic, opcode, raw token of a compact heartbeat, it has no echo and no
+# answer unless the token is invalid
+HEARTBEAT = struct.Struct('!BB' + TOKEN_FORMAT)
+HEARTBEAT_PREFIX = bytes((MAGIC, OP_HEARTBEAT))
+
+# Fields of each opcode: fixed size fields (B/H/I/q integers, t a token as
+# its 16 raw bytes), strings (s up to 255 bytes, S up to 4G bytes) and a tail
+# (b raw bytes, L list of integers, P list of packets). A packet is the head,
+# the fixed size fields and the string lengths packed in one struct, followed
+# by the strings and the tail. Absent integers are 0 (q -1), absent strings
+# and tokens are empty.
+CMD_FIELDS = ((('token', 't'), ('cursor', 'I'), ('limit', 'H'), ('z', 'B')),
+              (('since', 's'), ('args', 'S')), None)
+
+FIELDS = {
+    OP_LOG: ((), (('user', 's'), ('passwd', 'S')), None),
+    OP_REG: ((), (('user', 's'), ('passwd', 'S')), None),
+    OP_BATCH: ((('token', 't'),), (), ('batch', 'P')),
+    OP_META: ((('reply', 'B'),), (('proto', 's'), ('compress', 's')), None),
+    OP_RESEND: ((), (), ('resend', 'L')),
+    OP_RESPONSE: ((('code', 'H'), ('cursor', 'q')),
+                  (('msg', 'S'), ('data', 'S'), ('version', 's')), None),
+    OP_AUTH: ((('code', 'H'),), (('msg', 'S'), ('token', 's')), None),
+    OP_ERROR: ((('code', 'H'),), (('msg', 'S'), ('error', 's')), None),
+    OP_FRAG: ((('frag', 'I'), ('count', 'I')), (), ('data', 'b')),
+    OP_RESPONSE_Z: ((('code', 'H'), ('cursor', 'q')),
+                    (('msg', 'S'), ('version', 's')), ('data', 'b')),
+    OP_BATCH_RESPONSE: ((('code', 'H'),), (('msg', 'S'),), ('batch', 'P')),
+}
+
+# Fields left out of a decoded payload when absent, like in JSON payloads
+OPTIONAL = {'cursor', 'limit', 'since', 'version', 'proto', 'compress', 'z'}
+
+
+def pack_token(token: Optional[str]) -> bytes:
+    '''Raw bytes of a hex token, an absent token packs as zeros'''
+    try:
+        raw = bytes.fromhex(token or '')
+    except (TypeError, ValueError):
+        raw = b''
+    if len(raw) not in (0, TOKEN_BYTES):
+        # never matches a session, like a wrong token in JSON
+        raw = b'\xff' * TOKEN_BYTES
+    return raw
+
+
+def unpack_token(raw: bytes) -> str:
+    return raw.hex() if any(raw) else ''
+
+
+def compile_fields(fields) -> tuple:
+    ints, strs, tail = fields
+    fmt = HEAD.format + ''.join(TOKEN_FORMAT if kind == 't' else kind
+                                for _, kind in ints) + \
+        ''.join('B' if kind == 's' else 'I' for _, kind in strs)
+    return (struct.Struct(fmt), ints, [name for name, _ in strs], tail)
+
+
+CMD_LAYOUT = compile_fields(CMD_FIELDS)
+LAYOUTS = {op: compile_fields(fields) for op, fields in FIELDS.items()}
+
+
+def opcode(jd: Dict) -> int:
+    '''Opcode of a payload built by PayloadHelper'''
+    if 'frag' in jd:
+        return OP_FRAG
+    if 'resend' in jd:
+        return OP_RESEND
+    if 'meta' in jd:
+        return OP_META
+    if 'cmd' in jd:
+        if 'user' in jd:
+            return OP_LOG if jd['cmd'] == 'LOG' else OP_REG
+        if 'batch' in jd:
+            return OP_BATCH
+        return CMD_OPCODES.get(jd['cmd'], OP_UNKNOWN)
+    if 'error' in jd:
+        return OP_ERROR
+    if 'token' in jd:
+        return OP_AUTH
+    if 'batch' in jd:
+        return OP_BATCH_RESPONSE
+    if 'z' in jd:
+        return OP_RESPONSE_Z
+    return OP_RESPONSE
+
+
+def encode(jd: Dict) -> bytes:
+    '''Encode a payload dict, the echo must be an integer'''
+    op = opcode(jd)
+    layout, ints, strs, tail = LAYOUTS.get(op, CMD_LAYOUT)
+
+    values = [MAGIC, op, jd['echo']]
+    for name, kind in ints:
+        value = jd.get(name, None)
+        if kind == 't':
+            values.append(pack_token(value))
+            continue
+        if value is None:
+            value = -1 if kind == 'q' else 0
+        values.append(int(value))
+
+    raws = [(jd.get(name, None) or '').encode('utf-8') for name in strs]
+    values.extend(len(raw) for raw in raws)
+
+    parts = [layout.pack(*values)]
+    parts.extend(raws)
+
+    if tail:
+        name, kind = tail
+        value = jd[name]
+        if kind == 'L':
+            value = COUNT.pack(len(value)) + \
+                struct.pack(f'!{len(value)}I', *value)
+        elif kind == 'P':
+            value = COUNT.pack(len(value)) + \
+                b''.join(SIZE.pack(len(packet)) + packet for packet in value)
+        parts.append(value)
+
+    return b''.join(parts)
+
+
+def decode(raw: bytes) -> Dict:
+    '''Decode a binary payload into the dict the JSON one would give'''
+    try:
+        magic, op, echo = HEAD.unpack_from(raw)
+        if magic != MAGIC:
+            raise PayloadInvlidError(422, 'Payload invalid')
+
+        layout, ints, strs, tail = LAYOUTS.get(op, CMD_LAYOUT)
+        values = layout.unpack_from(raw)
+
+        jd = {'echo': echo}
+        if op == OP_META:
+            jd['meta'] = True
+        elif op in (OP_LOG, OP_REG):
+            jd['cmd'] = 'LOG' if op == OP_LOG else 'REG'
+        elif op == OP_BATCH:
+            jd['cmd'] = 'BATCH'
+        elif op == OP_RESPONSE_Z:
+            jd['z'] = 1
+        elif op not in FIELDS:
+            jd['cmd'] = CMD_NAMES.get(op, '?')
+
+        i = 3
+        for name, kind in ints:
+            value = values[i]
+            i += 1
+            if kind == 'q' and value == -1:
+                value = None
+            elif kind == 't':
+                value = unpack_token(value)
+            jd[name] = value
+
+        offset = layout.size
+        for name in strs:
+            end = offset + values[i]
+            i += 1
+            jd[name] = raw[offset:end].decode('utf-8')
+            offset = end
+
+        if tail:
+            name, kind = tail
+            if kind == 'L':
+                count, = COUNT.unpack_from(raw, offset)
+                value = list(struct.unpack_from(
+                    f'!{count}I', raw, offset + COUNT.size))
+            elif kind == 'P':
+                count, = COUNT.unpack_from(raw, offset)
+                offset += COUNT.size
+                value = []
+                for _ in range(count):
+                    size, = SIZE.unpack_from(raw, offset)
+                    offset += SIZE.size
+                    if offset + size > len(raw):
+                        raise PayloadInvlidError(422, 'Payload invalid')
+                    value.append(raw[offset:offset + size])
+                    offset += size
+            else:
+                value = raw[offset:]
+            jd[name] = value
+
+        for name in OPTIONAL.intersection(jd):
+            if jd[name] in (None, 0, ''):
+                del jd[name]
+
+        return jd
+
+    except (struct.error, UnicodeDecodeError):
+        raise PayloadInvlidError(422, 'Payload invalid')
+
+
+def encode_heartbeat(token: str) -> bytes:
+    return HEARTBEAT.pack(MAGIC, OP_HEARTBEAT, pack_token(token))
+
+
+def heartbeat_token(raw: bytes) -> Optional[str]:
+    '''Token of a compact heartbeat, None for any other packet'''
+    if len(raw) != HEARTBEAT.size or raw[:2] != HEARTBEAT_PREFIX:
+        return None
+    return unpack_token(HEARTBEAT.unpack(raw)[2])
+
+
+def is_binary(raw: bytes) -> bool:
+    return raw[:1] == MAGIC_BYTE
+
+
+def deserialize(raw: bytes) -> Dict:
+    '''Decode a JSON or binary payload'''
+    if is_binary(raw):
+        return decode(raw)
+    return json_deserializer(raw)
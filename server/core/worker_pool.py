@@ -0,0 +1,82 @@
+import socket
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Optional, Tuple
+
+from .utils import log
+
+# Threads running blocking calls and calls queued or running at most
+POOL_WORKERS = 2
+POOL_BACKLOG = 64
+
+Callback = Callable[[Any, Optional[BaseException]], None]
+
+
+class WorkerPool:
+    '''Run blocking calls on a bounded thread pool
+
+    Callbacks run on the event loop: the pool is readable once a call has
+    finished, the loop then calls run_callbacks(). It can be registered in a
+    selector or with loop.add_reader() as it has a fileno().
+    '''
+    executor: ThreadPoolExecutor
+    backlog: int
+    pending: int
+    finished: Deque[Tuple[Callback, Future]]
+    wakeup_r: socket.socket
+    wakeup_w: socket.socket
+
+    def __init__(self, workers: int = POOL_WORKERS, backlog: int = POOL_BACKLOG):
+        self.executor = ThreadPoolExecutor(workers)
+        self.backlog = backlog
+        self.pending = 0
+        self.finished = deque()
+
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+
+    def fileno(self) -> int:
+        return self.wakeup_r.fileno()
+
+    def submit(self, callback: Callback, fn: Callable, *args) -> bool:
+        '''Run fn(*args) on the pool, False if the backlog is full'''
+        if self.pending >= self.backlog:
+            return False
+
+        self.pending += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self.__finish(callback, f))
+        return True
+
+    def __finish(self, callback: Callback, future: Future):
+        # runs on a pool thread
+        self.finished.append((callback, future))
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            # the buffer is full, the loop is woken up already
+            pass
+
+    def run_callbacks(self):
+        '''Run the callbacks of finished calls, called by the event loop'''
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+        while self.finished:
+            callback, future = self.finished.popleft()
+            self.pending -= 1
+
+            error = future.exception()
+            try:
+                callback(None if error else future.result(), error)
+            except Exception as e:
+                log(f'Worker callback error: {e}', None, True)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.wakeup_r.close()
+        self.wakeup_w.close()
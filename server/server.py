@@ -1,147 +1,327 @@
 
 import os
-import select
+import selectors
 import socket
 import sys
-from queue import Empty, Queue
+import time
+from multiprocessing import Process
 from socket import socket as Socket
 
 from core.authenticator import Authenticator
 from core.forum_handler import ForumHandler
-from core.tcp_handler import TCPHandler
+from core.shared_state import (ForumView, SessionView, SharedStore,
+                               StateManager, init_state)
+from core.storage import DURABILITY_EVERY_OP
+from core.tcp_handler import TCPConnection, TCPHandler
 from core.udp_handler import UDPHandler
 from core.utils import log
+from core.worker_pool import WorkerPool
 
 LISTEN_ON = '0.0.0.0'
 
 RECV_BYTES = 8192
 
+# Largest UDP request accepted, a whole datagram
+UDP_RECV_BYTES = 65535
 
-def main(host, port):
-    # Init user authenticator
-    auth_file = os.path.abspath('./credentials.txt')
-    auth = Authenticator(auth_file)
+LISTEN_BACKLOG = socket.SOMAXCONN
 
-    # Init forum handler
-    db_path = os.path.abspath('./db.json')
-    data_path = os.path.abspath('./data/')
-    forum = ForumHandler(db_path, data_path)
+# db.json keeps a JSON snapshot and journal, *.db uses SQLite
+DB_FILE = './db.json'
 
+# Sessions and forum records read by the workers of --workers mode
+STORE_FILE = './shared.db'
+
+# every-op / interval / on-shutdown, see core.storage; interval and
+# on-shutdown trade the last records before a crash for throughput
+DURABILITY = DURABILITY_EVERY_OP
+FLUSH_INTERVAL = 0.05
+FLUSH_OPS = 64
+
+# Threads for file I/O and jobs queued or running at most
+IO_WORKERS = 4
+IO_BACKLOG = 1024
+
+
+def open_sockets(host: str, port: int, reuse_port: bool = False):
+    '''Bind UDP and TCP server sockets, return None on error'''
     # Init UDP server
     udp_socket = Socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         udp_socket.bind((host, port))
         log(f'UDP server listening on {host}:{port}', None, False)
     except OSError as s:
         log(f'UDP server start error: {s}', None, True)
-        return
+        udp_socket.close()
+        return None
 
     # Init TCP server
     tcp_socket = Socket(socket.AF_INET, socket.SOCK_STREAM)
     # tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     tcp_socket.setblocking(False)
     try:
         tcp_socket.bind((host, port))
-        tcp_socket.listen(10)
+        tcp_socket.listen(LISTEN_BACKLOG)
         log(f'TCP server listening on {host}:{port}', None, False)
     except OSError as s:
         log(f'TCP server start error: {s}', None, True)
-        return
+        udp_socket.close()
+        tcp_socket.close()
+        return None
 
-    # Init UDPHandler
-    udp_handler = UDPHandler(auth, forum, udp_socket)
+    return (udp_socket, tcp_socket)
 
-    # Init TCPHandler
-    tcp_handler = TCPHandler(auth, forum)
 
-    log('Wating for clients ...', None, False)
-
-    # Event loop
+def serve(udp_socket: Socket, tcp_socket: Socket, udp_handler: UDPHandler, tcp_handler: TCPHandler, auth: Authenticator = None):
+    '''Event loop, runs until KeyboardInterrupt, expires the tokens of auth'''
+    selector = selectors.DefaultSelector()
     try:
-        inputs = [tcp_socket, udp_socket]
-        outputs = []
-        msg_queue = {}
+        selector.register(tcp_socket, selectors.EVENT_READ, None)
+        selector.register(udp_socket, selectors.EVENT_READ, None)
+        # password hashing and file I/O pools
+        pools = [pool for pool in (udp_handler.pool, tcp_handler.pool) if pool]
+        for pool in pools:
+            selector.register(pool, selectors.EVENT_READ, None)
+
+        def close_conn(conn: TCPConnection):
+            if conn.events:
+                selector.unregister(conn.sock)
+            conn.close()
+
+        def update_events(conn: TCPConnection):
+            events = 0
+            if conn.want_read():
+                events |= selectors.EVENT_READ
+            if conn.want_write():
+                events |= selectors.EVENT_WRITE
+            if events == conn.events:
+                return
+
+            # stop reading while an upload waits for the disk
+            if not conn.events:
+                selector.register(conn.sock, events, conn)
+            elif not events:
+                selector.unregister(conn.sock)
+            else:
+                selector.modify(conn.sock, events, conn)
+            conn.events = events
+
+        def conn_ready(conn: TCPConnection):
+            if conn.closing and not conn.want_write():
+                close_conn(conn)
+            else:
+                update_events(conn)
+
         while True:
+            # sleep until the first session expires, for good without any
+            timeout = None
+            if auth:
+                auth.expire_tokens()
+                deadline = auth.next_expiry()
+                if deadline is not None:
+                    timeout = max(deadline - time.time(), 0)
+
+            for key, mask in selector.select(timeout):
+                s = key.fileobj
+                conn = key.data
 
-            rlist, wlist, elist = select.select(inputs, outputs, inputs, 1)
-            for s in rlist:
-                # any socket is ready for reading
                 if s == tcp_socket:
-                    # TCP incoming connection
-                    conn, addr = s.accept()
-                    conn.setblocking(False)
+                    # TCP incoming connections
+                    while True:
+                        try:
+                            sock, addr = s.accept()
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except OSError as e:
+                            log(f'TCP accept error: {e}', None, True)
+                            break
 
-                    inputs.append(conn)
-                    msg_queue[conn] = Queue()
-                    # log('TCP connection established', addr, False)
+                        sock.setblocking(False)
+                        conn = TCPConnection(sock, addr)
+                        conn.ready = lambda conn=conn: conn_ready(conn)
+                        selector.register(sock, conn.events, conn)
+                        # log('TCP connection established', addr, False)
 
                 elif s == udp_socket:
                     # UDP message
-                    data, addr = s.recvfrom(RECV_BYTES)
+                    try:
+                        data, addr = s.recvfrom(UDP_RECV_BYTES)
+                    except OSError:
+                        continue
                     udp_handler.handle_message(data, addr)
 
+                elif s in pools:
+                    # logins done hashing, file I/O done
+                    s.run_callbacks()
+
                 else:
-                    data = s.recv(RECV_BYTES)
-                    addr = s.getpeername()
-                    if data:
-                        # TCP message
-                        response = tcp_handler.handle_message(data, addr)
-                        msg_queue[s].put(response)
-                        if s not in outputs:
-                            outputs.append(s)
-
-                    else:
-                        # TCP close
-                        # log('TCP connection closed', addr, True)
-
-                        if s in outputs:
-                            outputs.remove(s)
-                        inputs.remove(s)
-                        s.close()
-                        msg_queue.pop(s, None)
-
-            for s in wlist:
-                # any socket is ready for writing
-                try:
-                    payload = msg_queue[s].get_nowait()
-                    s.send(payload)
-                    outputs.remove(s)
-                    msg_queue.pop(s, None)
-                except Empty:
-                    pass
-
-            for s in elist:
-                # any socket raises error
-                if s != udp_socket:
-
-                    log('TCP connection error', None, True)
-
-                    inputs.remove(s)
-                    if s in outputs:
-                        outputs.remove(s)
-
-                    msg_queue.pop(s, None)
-
-                    s.close()
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            data = s.recv(RECV_BYTES)
+                            if not data:
+                                # TCP close
+                                # log('TCP connection closed', addr, True)
+                                close_conn(conn)
+                                continue
+
+                            # TCP message
+                            tcp_handler.handle_data(conn, data)
+
+                        if mask & selectors.EVENT_WRITE and conn.want_write():
+                            tcp_handler.handle_write(conn)
+
+                    except (BlockingIOError, InterruptedError):
+                        pass
+
+                    except OSError:
+                        log('TCP connection error', None, True)
+                        close_conn(conn)
+                        continue
+
+                    conn_ready(conn)
 
     except KeyboardInterrupt:
         pass
     finally:
+        selector.close()
+
+
+def main(host, port):
+    # Init user authenticator
+    auth_file = os.path.abspath('./credentials.txt')
+    auth = Authenticator(auth_file)
+
+    # Init forum handler, file I/O runs on its own pool
+    io_pool = WorkerPool(IO_WORKERS, IO_BACKLOG)
+    db_path = os.path.abspath(DB_FILE)
+    data_path = os.path.abspath('./data/')
+    forum = ForumHandler(db_path, data_path,
+                         DURABILITY, FLUSH_INTERVAL, FLUSH_OPS, io_pool)
+
+    sockets = open_sockets(host, port)
+    if not sockets:
+        forum.close()
+        io_pool.close()
+        return
+    udp_socket, tcp_socket = sockets
+
+    # Init UDPHandler, password hashing runs on the worker pool
+    pool = WorkerPool()
+    udp_handler = UDPHandler(auth, forum, udp_socket, pool)
+
+    # Init TCPHandler
+    tcp_handler = TCPHandler(auth, forum, io_pool)
+
+    log('Wating for clients ...', None, False)
+
+    try:
+        serve(udp_socket, tcp_socket, udp_handler, tcp_handler, auth)
+    finally:
+        forum.close()
+        pool.close()
+        io_pool.close()
+        udp_socket.close()
+        tcp_socket.close()
+        log('Server shutdown ...', None, True)
+
+
+def worker_main(host, port, address, store_path, data_path):
+    '''Worker process, serves the shared port
+
+    Reads are served from the SharedStore and a local copy of the forum,
+    writes go to the state process.
+    '''
+    manager = StateManager(address)
+    manager.connect()
+    store = SharedStore(store_path)
+    auth = SessionView(manager.auth(), store)
+    forum = ForumView(manager.forum(), store, data_path)
+
+    sockets = open_sockets(host, port, True)
+    if not sockets:
+        return
+    udp_socket, tcp_socket = sockets
+
+    pool = WorkerPool()
+    io_pool = WorkerPool(IO_WORKERS, IO_BACKLOG)
+    udp_handler = UDPHandler(auth, forum, udp_socket, pool)
+    tcp_handler = TCPHandler(auth, forum, io_pool)
+
+    try:
+        serve(udp_socket, tcp_socket, udp_handler, tcp_handler)
+    finally:
+        pool.close()
+        io_pool.close()
         udp_socket.close()
         tcp_socket.close()
+
+
+def main_workers(host, port, workers):
+    '''Fork workers binding the same port with SO_REUSEPORT'''
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        log('SO_REUSEPORT is not supported, running a single process', None, True)
+        main(host, port)
+        return
+
+    auth_file = os.path.abspath('./credentials.txt')
+    db_path = os.path.abspath(DB_FILE)
+    data_path = os.path.abspath('./data/')
+    store_path = os.path.abspath(STORE_FILE)
+
+    # Authenticator and ForumHandler live in the state process
+    manager = StateManager()
+    manager.start(init_state, (auth_file, db_path, data_path, store_path,
+                               DURABILITY, FLUSH_INTERVAL, FLUSH_OPS))
+    forum = manager.forum()
+
+    processes = []
+    for _ in range(workers):
+        p = Process(target=worker_main,
+                    args=(host, port, manager.address, store_path, data_path),
+                    daemon=True)
+        p.start()
+        processes.append(p)
+
+    log(f'Wating for clients with {workers} workers ...', None, False)
+
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.join()
+    finally:
+        forum.close()
+        manager.shutdown()
         log('Server shutdown ...', None, True)
 
 
 if __name__ == '__main__':
 
     try:
-        port = int((sys.argv[1:] or ['9999'])[0])
+        args = sys.argv[1:]
+        workers = 1
+        if '--workers' in args:
+            i = args.index('--workers')
+            workers = int(args[i + 1])
+            args = args[:i] + args[i + 2:]
+            if workers < 1:
+                raise ValueError
+
+        port = int((args or ['9999'])[0])
         if port < 0 or port > 65535:
             raise ValueError
-    except ValueError:
-        log('Usage: python3 server.py [port]', None, True)
+    except (ValueError, IndexError):
+        log('Usage: python3 server.py [port] [--workers N]', None, True)
         log('Default port is 9999', None, True)
         input('Press enter to exit...')
         exit(1)
 
-    main(LISTEN_ON, port)
+    if workers > 1:
+        main_workers(LISTEN_ON, port, workers)
+    else:
+        main(LISTEN_ON, port)